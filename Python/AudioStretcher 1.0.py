@@ -1,9 +1,13 @@
 import customtkinter as ctk
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import numpy as np
-import wave
-import sounddevice as sd
+from audio_document import AUDIO_EXTENSIONS, open_document
+from background import BackgroundWorker
+from history import History
+from playback import PlaybackEngine
+from profiling import TimingOverlay, instrument_canvas, save_trace, timed
+from session import load_session, save_session
+from waveform_view import BeatGrid, WaveformView
 
 # Variabili globali
 canvas = None
@@ -13,6 +17,15 @@ markers = []  # Posizioni dei marker
 is_playing = False  # Stato del tasto Preview (True = Riproduzione attiva)
 bpm = 120  # BPM iniziale (120 BPM di default)
 beat_positions = []  # Posizioni calcolate delle linee BPM
+beat_grid = None  # Griglia BPM disegnata come un'unica collezione
+marker_lines = []  # Artisti matplotlib dei marker, nello stesso ordine di markers
+dragged_marker = None  # Indice del marker in trascinamento (None = nessun trascinamento)
+drag_background = None  # Sfondo statico salvato per il blitting durante il trascinamento
+DRAG_TOLERANCE = 12  # Distanza massima in pixel per afferrare un marker
+playback = PlaybackEngine()  # Motore di riproduzione condiviso (seek, loop, cursore)
+PLAYHEAD_INTERVAL = 50  # Millisecondi tra due aggiornamenti della posizione di riproduzione
+history = History()  # Stati (BPM, marker) per annulla/ripeti
+SESSION_APP = 'AudioStretcher'  # Nome dello stato di questa applicazione nei file di sessione
 
 def update_bpm():
     """Aggiorna il valore di BPM e ridisegna il grafico."""
@@ -22,7 +35,8 @@ def update_bpm():
         if 30 <= new_bpm <= 180:
             bpm = new_bpm
             print(f"BPM aggiornato a: {bpm}")
-            update_graph()  # Aggiorna il grafico con le nuove barre rosse
+            update_beat_grid()  # Aggiorna sul posto le barre rosse
+            record_state()
         else:
             print("Il valore di BPM deve essere compreso tra 30 e 180.")
     except ValueError:
@@ -34,6 +48,16 @@ def calculate_beat_positions(framerate, duration, bpm):
     num_beats = int(duration / beat_interval)
     return [i * beat_interval for i in range(num_beats)]
 
+def update_beat_grid():
+    """Aggiorna la griglia BPM esistente senza ridisegnare la forma d'onda."""
+    global beat_positions
+    if not selected_file or beat_grid is None:
+        return
+    document = open_document(selected_file)
+    beat_positions = calculate_beat_positions(document.framerate, document.duration, bpm)
+    beat_grid.set_interval(60 / bpm)
+    canvas.draw_idle()
+
 def update_graph_visibility():
     """Aggiorna la visibilità del grafico in base al caricamento del file."""
     if selected_file:
@@ -41,50 +65,17 @@ def update_graph_visibility():
     else:
         canvas.get_tk_widget().pack_forget()  # Nascondi il grafico
         
+@timed('plot')
 def update_graph():
     """Aggiorna il grafico con i marker e le linee BPM."""
-    global beat_positions
+    global beat_positions, beat_grid, marker_lines
     if not selected_file:
         return
 
-    with wave.open(selected_file, 'r') as wav_file:
-        n_frames = wav_file.getnframes()
-        framerate = wav_file.getframerate()
-        frames = wav_file.readframes(n_frames)
-        waveform = np.frombuffer(frames, dtype=np.int16)
-        time = np.linspace(0, n_frames / framerate, num=n_frames)
+    document = open_document(selected_file)  # Documento condiviso, decodificato una sola volta
+    framerate = document.framerate
 
-    duration = len(time) / framerate  # Durata totale dell'audio in secondi
-    beat_positions = calculate_beat_positions(framerate, duration, bpm)
-
-    ax = canvas.figure.axes[0]
-    ax.clear()
-    ax.set_facecolor('#2b2b2b')  # Sfondo grigio scuro
-    ax.spines['top'].set_color('#2b2b2b')  # Cornice grigio scuro
-    ax.spines['right'].set_color('#2b2b2b')
-    ax.spines['left'].set_color('#2b2b2b')
-    ax.spines['bottom'].set_color('#2b2b2b')
-    ax.plot(time, waveform, color='orange', label="Forma d'onda originale")
-
-    # Disegna le linee verticali rosse per ogni battito
-    for beat in beat_positions:
-        ax.axvline(x=beat, color='red', linestyle='--', label='BPM Marker' if beat == beat_positions[0] else None)
-
-    # Disegna i marker
-    for marker in markers:
-        ax.axvline(x=marker, color='white', linestyle='--')
-
-    ax.legend()
-    canvas.draw()
-
-    with wave.open(selected_file, 'r') as wav_file:
-        n_frames = wav_file.getnframes()
-        framerate = wav_file.getframerate()
-        frames = wav_file.readframes(n_frames)
-        waveform = np.frombuffer(frames, dtype=np.int16)
-        time = np.linspace(0, n_frames / framerate, num=n_frames)
-
-    duration = len(time) / framerate  # Durata totale dell'audio in secondi
+    duration = document.duration  # Durata totale dell'audio in secondi
     beat_positions = calculate_beat_positions(framerate, duration, bpm)
 
     ax = canvas.figure.axes[0]
@@ -94,42 +85,96 @@ def update_graph():
     ax.spines['right'].set_color('#333333')
     ax.spines['left'].set_color('#333333')
     ax.spines['bottom'].set_color('#333333')
-    ax.plot(time, waveform, color='orange', label="Forma d'onda originale")
+    WaveformView(ax, document.pyramid(), color='orange', label="Forma d'onda originale")
 
-    # Disegna le linee verticali rosse per ogni battito
-    for beat in beat_positions:
-        ax.axvline(x=beat, color='red', linestyle='--', label='BPM Marker' if beat == beat_positions[0] else None)
+    # Disegna le linee verticali rosse dei battiti visibili in un'unica collezione
+    beat_grid = BeatGrid(ax, 60 / bpm, duration, color='red', linestyle='--', label='BPM Marker')
 
     # Disegna i marker
-    for marker in markers:
-        ax.axvline(x=marker, color='white', linestyle='--')
+    marker_lines = [ax.axvline(x=marker, color='white', linestyle='--') for marker in markers]
+
+    # Il loop segue zoom e spostamenti della vista
+    ax.callbacks.connect('xlim_changed', lambda axes: update_loop())
 
     ax.legend()
     canvas.draw()
 
 def select_file():
-    """Carica un file WAV e visualizza la forma d'onda con i marker BPM."""
+    """Carica un file audio e visualizza la forma d'onda con i marker BPM."""
     global selected_file
-    selected_file = ctk.filedialog.askopenfilename(filetypes=[("WAV files", "*.wav")])
+    file_path = ctk.filedialog.askopenfilename(
+        filetypes=[("Audio files", " ".join(f"*{extension}" for extension in AUDIO_EXTENSIONS)),
+                   ("WAV files", "*.wav")]
+    )
+    if file_path:
+        save_current_session()
+        # Decodifica e piramide in background: la finestra resta reattiva durante il caricamento
+        worker.submit(
+            'load', lambda progress: load_file(file_path),
+            on_done=lambda result: file_loaded(*result),
+            on_error=lambda e: print(f"Errore durante il caricamento del file: {e}")
+        )
+    else:
+        selected_file = file_path
+        canvas.get_tk_widget().pack_forget()  # Nascondi il grafico se non c'è un file
+
+def load_file(file_path):
+    """Nel thread di lavoro: decodifica il file e prepara la piramide, letta dalla sessione se c'è."""
+    document = open_document(file_path)
+    session = load_session(document, SESSION_APP)
+    document.pyramid()
+    return file_path, session
+
+def file_loaded(file_path, session=None):
+    """Mostra il file caricato in background con i marker BPM."""
+    global selected_file, bpm
+    selected_file = file_path
     if selected_file:
+        if session is not None:
+            # Marker e BPM come alla chiusura precedente
+            history.restore(session['history'])
+            bpm, saved_markers = history.current
+            markers[:] = saved_markers
+        else:
+            markers.clear()
+        bpm_entry.delete(0, ctk.END)
+        bpm_entry.insert(0, str(bpm))
         update_graph()  # Aggiorna il grafico
         canvas.get_tk_widget().pack(fill='both', expand=True)  # Mostra il grafico
+        document = open_document(selected_file)
+        playback.set_source(document.samples, document.framerate)
+        playback.seek(0)
         preview_button.pack(pady=10)  # Mostra il tasto Preview
+        loop_checkbox.pack(pady=(0, 5))
+        playhead_label.pack(pady=(0, 10))
+        update_playhead_label()
+        if session is None:
+            history.reset(current_state())
+        undo_button.pack(pady=(0, 5))
+        redo_button.pack(pady=(0, 10))
+        update_history_buttons()
         bpm_frame.pack(pady=10)  # Mostra il controllo BPM
-    else:
-        canvas.get_tk_widget().pack_forget()  # Nascondi il grafico se non c'è un file
 
 def add_marker(event):
     """Aggiunge o rimuove un marker cliccando sul grafico."""
     global markers
+    if event.button == 3:  # Click destro: sposta la riproduzione nel punto cliccato
+        if event.xdata is not None:
+            playback.seek(event.xdata)
+            update_playhead_label()
+        return
+
     if event.dblclick:  # Se l'utente fa doppio clic, rimuovi il marker
         if len(markers) > 0:
             print(f"Marker rimosso: {markers[0]}")
             markers.clear()
             update_graph()
+            record_state()
         return
 
     if len(markers) > 0:
+        if start_drag(event):  # Click vicino al marker: inizia il trascinamento
+            return
         print("Esiste già un marker. Spostalo o cancellalo per crearne uno nuovo.")
         return  # Non consentire di aggiungere altri marker
 
@@ -137,52 +182,156 @@ def add_marker(event):
         markers.append(event.xdata)
         print(f"Marker aggiunto: {event.xdata}")
         update_graph()
+        record_state()
+
+@timed('drag start')
+def start_drag(event):
+    """Inizia il trascinamento se il click è vicino a un marker e salva lo sfondo statico."""
+    global dragged_marker, drag_background
+    if event.button != 1 or event.x is None:
+        return False
 
+    # Trova il marker più vicino al punto cliccato, con la tolleranza in pixel
+    ax = canvas.figure.axes[0]
+    for idx, marker in enumerate(markers):
+        marker_x = ax.transData.transform((marker, 0))[0]
+        if abs(marker_x - event.x) < DRAG_TOLERANCE:
+            dragged_marker = idx
+            break
+    else:
+        return False
+
+    # Ridisegna tutto tranne il marker e conserva lo sfondo (forma d'onda e griglia BPM)
+    line = marker_lines[dragged_marker]
+    line.set_animated(True)
+    canvas.draw()
+    drag_background = canvas.copy_from_bbox(ax.bbox)
+    ax.draw_artist(line)
+    canvas.blit(ax.bbox)
+    return True
+
+@timed('drag marker')
 def drag_marker(event):
-    """Gestisce lo spostamento di un marker tramite drag & drop."""
-    global markers
-    if event.button == 1 and event.xdata:  # Verifica che il pulsante sinistro del mouse sia premuto
-        tolerance = 12 / canvas.figure.get_size_inches()[0] / canvas.figure.dpi  # Tolleranza in unità del grafico
-        closest_marker = None
-
-        # Trova il marker più vicino al punto cliccato considerando la tolleranza
-        for marker in markers:
-            if abs(marker - event.xdata) < tolerance:
-                closest_marker = marker
-                break
-
-        if closest_marker is not None:
-            idx = markers.index(closest_marker)
-
-            # Calcola i limiti per lo spostamento
-            min_limit = 0 if idx == 0 else beat_positions[max(0, idx - 1)]  # Limite minimo: barra BPM precedente
-            max_limit = beat_positions[min(len(beat_positions) - 1, idx + 1)]  # Limite massimo: barra BPM successiva
-
-            # Aggiorna la posizione del marker restando nei limiti
-            new_position = max(min(event.xdata, max_limit), min_limit)
-            markers[idx] = new_position  # Aggiorna la posizione del marker
-            print(f"Marker spostato: {closest_marker} -> {new_position}")
-            update_graph()
+    """Gestisce lo spostamento di un marker tramite drag & drop, ridisegnando solo il marker."""
+    if dragged_marker is None or event.button != 1 or event.xdata is None:
+        return
+
+    idx = dragged_marker
+
+    # Calcola i limiti per lo spostamento
+    min_limit = 0 if idx == 0 else beat_positions[max(0, idx - 1)]  # Limite minimo: barra BPM precedente
+    max_limit = beat_positions[min(len(beat_positions) - 1, idx + 1)]  # Limite massimo: barra BPM successiva
+
+    # Aggiorna la posizione del marker restando nei limiti
+    markers[idx] = max(min(event.xdata, max_limit), min_limit)
+
+    # Ripristina lo sfondo salvato e ridisegna solo l'artista del marker
+    ax = canvas.figure.axes[0]
+    line = marker_lines[idx]
+    line.set_xdata([markers[idx], markers[idx]])
+    canvas.restore_region(drag_background)
+    ax.draw_artist(line)
+    canvas.blit(ax.bbox)
+
+def end_drag(event):
+    """Termina il trascinamento e riporta il marker nel disegno normale."""
+    global dragged_marker, drag_background
+    if dragged_marker is None:
+        return
+
+    marker_lines[dragged_marker].set_animated(False)
+    print(f"Marker spostato: {markers[dragged_marker]}")
+    dragged_marker = None
+    drag_background = None
+    canvas.draw_idle()
+    record_state()
+
+def current_state():
+    """Stato modificabile dall'utente: BPM e posizioni dei marker (tuple immutabili)."""
+    return bpm, tuple(markers)
+
+def record_state():
+    """Aggiunge lo stato corrente alla cronologia dopo una modifica."""
+    history.push(current_state())
+    update_history_buttons()
+
+def restore_state(state):
+    """Ripristina BPM e marker di uno stato della cronologia."""
+    global bpm
+    bpm, saved_markers = state
+    markers[:] = saved_markers
+    bpm_entry.delete(0, ctk.END)
+    bpm_entry.insert(0, str(bpm))
+    update_graph()
+    update_history_buttons()
+
+def save_current_session():
+    """Salva accanto al file aperto marker, BPM, cronologia e piramide, per riaprirlo all'istante."""
+    if not selected_file:
+        return
+    try:
+        save_session(open_document(selected_file), SESSION_APP, {'history': history.snapshot()})
+    except Exception as e:
+        print(f"Errore durante il salvataggio della sessione: {e}")
+
+def undo(event=None):
+    if dragged_marker is not None:
+        return  # Non durante un trascinamento
+    state = history.undo()
+    if state is not None:
+        restore_state(state)
+
+def redo(event=None):
+    if dragged_marker is not None:
+        return
+    state = history.redo()
+    if state is not None:
+        restore_state(state)
+
+def update_history_buttons():
+    undo_button.configure(state="normal" if history.can_undo() else "disabled")
+    redo_button.configure(state="normal" if history.can_redo() else "disabled")
 
 def preview_file():
     """Riproduce o interrompe l'audio (originale o modificato)."""
     global is_playing  # Accedi alla variabile globale
     if is_playing:
         # Se è in riproduzione, ferma l'audio
-        sd.stop()
+        playback.stop()
         print("Riproduzione interrotta.")
         preview_button.configure(text="Preview")  # Modifica la caption del pulsante
         is_playing = False
     else:
-        # Se non è in riproduzione, avvia l'audio
+        # Se non è in riproduzione, avvia l'audio dal cursore senza copiare il file
         if selected_file:
-            with wave.open(selected_file, 'r') as wav_file:
-                framerate = wav_file.getframerate()
-                frames = wav_file.readframes(wav_file.getnframes())
-                waveform = np.frombuffer(frames, dtype=np.int16)
-                sd.play(waveform, samplerate=framerate)
+            document = open_document(selected_file)
+            playback.set_source(document.samples, document.framerate)
+            update_loop()
+            playback.play()
             preview_button.configure(text="Stop")  # Modifica la caption del pulsante
             is_playing = True
+            update_playhead()
+
+def update_loop():
+    """Ripete l'intervallo visibile nel grafico se il loop è attivo."""
+    if loop_checkbox.get():
+        playback.set_loop(*canvas.figure.axes[0].get_xlim())
+    else:
+        playback.set_loop()
+
+def update_playhead_label():
+    """Mostra la posizione di riproduzione sotto i controlli."""
+    playhead_label.configure(text=f"{playback.position:.1f} / {playback.duration:.1f} s")
+
+def update_playhead():
+    """Aggiorna il cursore durante la riproduzione e ripristina il tasto Preview alla fine."""
+    global is_playing
+    update_playhead_label()
+    if playback.active:
+        root.after(PLAYHEAD_INTERVAL, update_playhead)
+    elif is_playing:
+        preview_button.configure(text="Preview")
+        is_playing = False
 
 # Configurazione CustomTkinter
 ctk.set_appearance_mode("dark")
@@ -193,18 +342,35 @@ root = ctk.CTk()
 root.title("Editor Audio")
 root.geometry("1000x600")
 
+# Thread di lavoro per il caricamento dei file
+worker = BackgroundWorker(root)
+
 main_frame = ctk.CTkFrame(root)
 main_frame.pack(fill="both", expand=True, padx=20, pady=20)
 
 control_frame = ctk.CTkFrame(main_frame)
 control_frame.pack(side="left", fill="y", padx=20)
 
-select_button = ctk.CTkButton(control_frame, text="Seleziona file WAV", command=select_file)
+select_button = ctk.CTkButton(control_frame, text="Seleziona file audio", command=select_file)
 select_button.pack(pady=10)
 
 preview_button = ctk.CTkButton(control_frame, text="Preview", command=preview_file)
 preview_button.pack_forget()  # Nascondi il tasto Preview all'inizio
 
+# Loop sull'intervallo visibile e posizione di riproduzione (click destro sul grafico per spostarla)
+loop_checkbox = ctk.CTkCheckBox(control_frame, text="Loop vista", command=update_loop)
+loop_checkbox.pack_forget()
+playhead_label = ctk.CTkLabel(control_frame, text="")
+playhead_label.pack_forget()
+
+# Annulla/ripeti per marker e BPM (anche con Ctrl+Z / Ctrl+Y)
+undo_button = ctk.CTkButton(control_frame, text="Annulla", command=undo)
+undo_button.pack_forget()
+redo_button = ctk.CTkButton(control_frame, text="Ripeti", command=redo)
+redo_button.pack_forget()
+root.bind("<Control-z>", undo)
+root.bind("<Control-y>", redo)
+
 bpm_frame = ctk.CTkFrame(control_frame)
 bpm_label = ctk.CTkLabel(bpm_frame, text="BPM:")
 bpm_label.pack(side="left", padx=5)
@@ -221,8 +387,16 @@ graph_frame.pack(side="left", fill="both", expand=True)
 fig, ax = plt.subplots(figsize=(8, 4))
 canvas = FigureCanvasTkAgg(fig, master=graph_frame)
 canvas.get_tk_widget().pack(fill='both', expand=True)
+instrument_canvas(canvas)
+
+# Tempi delle fasi sopra il grafico (F12); UFFADUEVOLTE_TRACE=file.json li esporta alla chiusura
+timing_overlay = TimingOverlay(root, canvas.get_tk_widget())
+root.bind("<F12>", timing_overlay.toggle)
 canvas.mpl_connect("button_press_event", add_marker)
 canvas.mpl_connect("motion_notify_event", drag_marker)
+canvas.mpl_connect("button_release_event", end_drag)
 
 update_graph()  # Aggiorna il grafico all'avvio
 root.mainloop()
+save_current_session()
+save_trace()
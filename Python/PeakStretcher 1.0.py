@@ -1,21 +1,42 @@
 import customtkinter as ctk
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import numpy as np
-import wave
-import sounddevice as sd
-from scipy.signal import find_peaks
-from scipy.interpolate import interp1d
-from scipy.signal import resample
 from matplotlib.widgets import RectangleSelector
+from audio_document import AUDIO_EXTENSIONS, open_document
+from background import BackgroundWorker
+from history import History
+from peak_batch import write_wav
+from peak_stretch import PeakIndex, adjust_waveform
+from playback import PlaybackEngine
+from profiling import TimingOverlay, instrument_canvas, save_trace, timed
+from session import load_session, save_session
+from tempo import estimate_tempo
+from waveform_pyramid import WaveformPyramid
+from waveform_view import BeatGrid, WaveformView
 
 # Variabili globali
 canvas = None
 selected_file = None
 update_delay = None  # Timer per gestire ritardi nell'aggiornamento
 adjusted_audio = None  # Contiene il segnale audio rielaborato
+adjusted_key = None  # Parametri dell'Adjust mostrato, riusati dall'esportazione
+detected_tempo = None  # (BPM, affidabilità, fase) rilevati all'apertura, salvati nella sessione
 selected_range = None  # Variabile globale per memorizzare il range selezionato
 rectangle_selector = None  # Variabile globale per il selettore
+beat_grid = None  # Griglia BPM disegnata come un'unica collezione
+beat_phase = 0.0  # Posizione in secondi del primo battito rilevato
+playback = PlaybackEngine()  # Motore di riproduzione condiviso (seek, loop, cursore)
+PLAYHEAD_INTERVAL = 50  # Millisecondi tra due aggiornamenti della posizione di riproduzione
+history = History()  # Stati (BPM, range, motore, Adjust sì/no) per annulla/ripeti: nessun campione
+render_cache = OrderedDict()  # Parametri di Adjust -> risultato, per annulla/ripeti immediati
+RENDER_CACHE_SIZE = 3  # Risultati di Adjust tenuti in memoria
+PREVIEW_QUALITY = 'draft'  # Ricampionamento delle prove interattive (Adjust)
+EXPORT_QUALITY = 'high'  # Ricampionamento del file esportato
+SESSION_APP = 'PeakStretcher'  # Nome dello stato di questa applicazione nei file di sessione
+
+# Motori di Adjust: None sposta i segmenti, gli altri preservano l'intonazione
+STRETCH_ENGINES = {"Resample": None, "WSOLA": "wsola", "Phase vocoder": "phase-vocoder"}
 
 def onselect(eclick, erelease):
     """Gestisce la selezione dell'area nel grafico."""
@@ -38,45 +59,73 @@ def enable_selector(ax):
     global rectangle_selector
     rectangle_selector = RectangleSelector(
         ax, onselect,
+        button=[1],  # Il click destro resta libero per spostare la riproduzione
         interactive=True,  # Consente l'interazione con il rettangolo
         props=dict(facecolor='blue', edgecolor='black', alpha=0.3, fill=True)  # Stile del rettangolo
     )
 
 def detect_bpm(waveform, framerate):
-    """Rileva automaticamente il BPM calcolando gli intervalli tra i picchi."""
+    """Rileva BPM, affidabilità (0-1) e fase del primo battito dall'inviluppo degli attacchi."""
     try:
-        # Trova i picchi nel segnale audio
-        peaks, _ = find_peaks(waveform, height=np.max(waveform) * 0.5, distance=framerate * 0.2)
-        
-        # Calcola gli intervalli temporali tra i picchi
-        if len(peaks) > 1:
-            intervals = np.diff(peaks) / framerate  # Intervalli in secondi
-            avg_interval = np.mean(intervals)  # Intervallo medio
-            bpm = int(60 / avg_interval)  # Converte l'intervallo medio in BPM
-            return bpm
-        else:
-            return 120  # Valore di default se non ci sono abbastanza picchi
+        bpm, confidence, phase = estimate_tempo(waveform, framerate)
+        return int(round(bpm)), confidence, phase
     except Exception as e:
         print(f"Errore durante il calcolo del BPM: {e}")
-        return 120  # Valore di default in caso di errore
+        return 120, 0.0, 0.0  # Valore di default in caso di errore
 
 def select_file():
-    """Apri finestra di dialogo per selezionare un file .wav e rileva automaticamente il BPM."""
-    global selected_file, adjusted_audio
-    selected_file = ctk.filedialog.askopenfilename(filetypes=[("WAV files", "*.wav")])
+    """Apri finestra di dialogo per selezionare un file audio e rileva automaticamente il BPM."""
+    file_path = ctk.filedialog.askopenfilename(
+        filetypes=[("Audio files", " ".join(f"*{extension}" for extension in AUDIO_EXTENSIONS)),
+                   ("WAV files", "*.wav")]
+    )
+    if not file_path:
+        return
+
+    # Caricamento, piramide e rilevamento BPM in background: la finestra resta reattiva
+    worker.cancel('adjust')
+    save_current_session()
+    message_label.configure(text="Caricamento del file...")
+    message_label.pack(side="bottom", pady=(10, 5))
+    worker.submit(
+        'load', lambda progress: load_file(file_path, progress),
+        on_done=file_loaded,
+        on_error=lambda e: print(f"Errore durante il caricamento del file: {e}"),
+        on_progress=lambda fraction: message_label.configure(text=f"Caricamento del file... {fraction:.0%}")
+    )
+
+def load_file(file_path, progress):
+    """Nel thread di lavoro: decodifica il file, prepara la piramide e rileva il BPM.
+
+    Con una sessione valida accanto al file piramide, indice dei picchi e BPM
+    vengono letti da lì invece di essere ricalcolati.
+    """
+    document = open_document(file_path)
+    session = load_session(document, SESSION_APP)
+    progress(0.4)
+    document.pyramid()
+    progress(0.6)
+    if session is not None:
+        detected_bpm, confidence, phase = session['tempo']
+    else:
+        detected_bpm, confidence, phase = detect_bpm(document.samples, document.framerate)
+    return file_path, document, detected_bpm, confidence, phase, session
+
+def file_loaded(result):
+    """Nel thread di Tk: mostra il file caricato in background."""
+    global selected_file, adjusted_audio, beat_phase, detected_tempo
+    selected_file, document, detected_bpm, confidence, beat_phase, session = result
+    detected_tempo = (detected_bpm, confidence, beat_phase)
     adjusted_audio = None  # Reset dell'audio rielaborato
+    export_button.configure(state="disabled")
 
     if selected_file:
         try:
-            # Carica il file e calcola il BPM
-            with wave.open(selected_file, 'r') as wav_file:
-                n_frames = wav_file.getnframes()
-                framerate = wav_file.getframerate()
-                frames = wav_file.readframes(n_frames)
-                waveform = np.frombuffer(frames, dtype=np.int16)
-
-            # Rileva il BPM e imposta il valore nella casella BPM
-            detected_bpm = detect_bpm(waveform, framerate)
+            playback.set_source(document.samples, document.framerate)
+            playback.seek(0)
+
+            # Imposta il BPM rilevato (su tutti i canali) nella casella BPM
+            print(f"BPM rilevato: {detected_bpm} (affidabilità {confidence:.0%}, primo battito a {beat_phase:.3f} s)")
             bpm_entry.delete(0, ctk.END)
             bpm_entry.insert(0, str(detected_bpm))
 
@@ -86,8 +135,20 @@ def select_file():
             # Disabilita il tasto Adjust fino alla selezione
             adjust_button.configure(state="disabled")
 
+            # La cronologia riparte dal file appena caricato, o da quella salvata nella sessione
+            if session is not None:
+                history.restore(session['history'])
+                restore_state(history.current)
+                if selected_range is not None:
+                    adjust_button.configure(state="normal")
+                print("Sessione ripristinata.")
+            else:
+                history.reset(current_state())
+            update_history_buttons()
+
             # Abilita il tasto preview
             preview_button.configure(state="normal")
+            update_playhead_label()
 
             # Mostra il messaggio sotto il grafico
             message_label.configure(text="Seleziona un range di ampiezza nel grafico per proseguire.")
@@ -96,41 +157,71 @@ def select_file():
             print(f"Errore durante il caricamento del file: {e}")
 
 def preview_file():
-    """Riproduce il file originale o rielaborato."""
+    """Riproduce o interrompe il file originale o rielaborato."""
+    if playback.active:
+        playback.stop()
+        preview_button.configure(text="Preview")
+        return
+    if not selected_file:
+        return
     if adjusted_audio is not None:
         # Riproduce l'audio rielaborato se disponibile
         print("Riproducendo audio rielaborato...")
-        with wave.open(selected_file, 'r') as wav_file:
-            framerate = wav_file.getframerate()
-        sd.play(adjusted_audio, samplerate=framerate)
-    elif selected_file:
+    else:
         # Riproduce il file originale
         print("Riproducendo audio originale...")
-        with wave.open(selected_file, 'r') as wav_file:
-            framerate = wav_file.getframerate()
-            frames = wav_file.readframes(wav_file.getnframes())
-            waveform = np.frombuffer(frames, dtype=np.int16)
-            sd.play(waveform, samplerate=framerate)
+    update_playback_source()
+    update_loop()
+    playback.play()
+    preview_button.configure(text="Stop")
+    update_playhead()
+
+def update_playback_source():
+    """Passa al motore di riproduzione l'audio rielaborato, o l'originale se non c'è."""
+    document = open_document(selected_file)
+    if adjusted_audio is not None:
+        playback.set_source(adjusted_audio, document.framerate)
+    else:
+        playback.set_source(document.samples, document.framerate)
+
+def update_loop():
+    """Ripete l'intervallo visibile nel grafico se il loop è attivo."""
+    if loop_checkbox.get() and canvas is not None:
+        playback.set_loop(*canvas.figure.axes[0].get_xlim())
+    else:
+        playback.set_loop()
+
+def seek_playback(event):
+    """Click destro sul grafico: sposta la riproduzione nel punto cliccato."""
+    if event.button == 3 and event.xdata is not None:
+        playback.seek(event.xdata)
+        update_playhead_label()
+
+def update_playhead_label():
+    """Mostra la posizione di riproduzione sotto i controlli."""
+    playhead_label.configure(text=f"{playback.position:.1f} / {playback.duration:.1f} s")
+
+def update_playhead():
+    """Aggiorna il cursore durante la riproduzione e ripristina il tasto Preview alla fine."""
+    update_playhead_label()
+    if playback.active:
+        root.after(PLAYHEAD_INTERVAL, update_playhead)
+    else:
+        preview_button.configure(text="Preview")
 
 def update_waveform_with_markers(marker_positions):
     """Aggiorna il grafico per mostrare i marker verticali."""
     try:
         # Cancella i marker esistenti
         plt.clf()  # Pulisce la figura corrente
-        with wave.open(selected_file, 'r') as wav_file:
-            n_frames = wav_file.getnframes()
-            framerate = wav_file.getframerate()
-            frames = wav_file.readframes(n_frames)
-            waveform = np.frombuffer(frames, dtype=np.int16)
-            duration = n_frames / framerate
-            time = np.linspace(0, duration, num=n_frames)
+        document = open_document(selected_file)
 
         # Disegna la forma d'onda
-        plt.plot(time, waveform, label="Waveform", color="orange")
+        WaveformView(plt.gca(), document.pyramid(), label="Waveform", color="orange")
 
-        # Aggiungi i marker verticali
-        for marker in marker_positions:
-            plt.axvline(x=marker, color='blue', linestyle='--', label="Marker")
+        # Aggiungi i marker verticali in un'unica collezione
+        ax = plt.gca()
+        ax.vlines(marker_positions, 0, 1, transform=ax.get_xaxis_transform(), color='blue', linestyle='--', label="Marker")
 
         # Configura il grafico
         plt.xlabel("Time (s)")
@@ -144,44 +235,37 @@ def update_waveform_with_markers(marker_positions):
     except Exception as e:
         print(f"Errore durante l'aggiornamento dei marker: {e}")
 
+@timed('update markers')
 def update_markers():
     """Aggiorna solo i marker verticali nel grafico quando cambiano i BPM."""
+    global beat_grid
     if not selected_file or not canvas:
         return
 
     try:
-        # Rileggi il file originale per calcolare i marker
-        with wave.open(selected_file, 'r') as wav_file:
-            n_frames = wav_file.getnframes()
-            framerate = wav_file.getframerate()
-            duration = n_frames / framerate
+        # Usa la durata del documento già caricato
+        duration = open_document(selected_file).duration
 
-        # Calcola le posizioni dei marker in base ai BPM
+        # Calcola l'intervallo dei marker in base ai BPM
         bpm = int(bpm_entry.get())
         interval = 60 / bpm  # Intervallo tra i marker in secondi
-        marker_positions = np.arange(0, duration, interval)
 
         # Ottieni l'asse corrente dal canvas
         ax = canvas.figure.axes[0]
 
-        # Rimuovi i vecchi marker
-        for line in ax.get_lines():
-            if line.get_linestyle() == '--':  # Identifica le linee tratteggiate dei marker
-                line.remove()
-
-        # Aggiungi i nuovi marker
-        for i, t in enumerate(marker_positions):
-            if i == 0:  # Aggiungi "Marker" solo per il primo
-                ax.axvline(x=t, color='red', linestyle='--', alpha=0.7, label="Marker")
-            else:
-                ax.axvline(x=t, color='red', linestyle='--', alpha=0.7)
+        # Aggiorna sul posto la griglia esistente (o la crea se manca)
+        if beat_grid is None or beat_grid.ax is not ax:
+            beat_grid = BeatGrid(ax, interval, duration, offset=beat_phase,
+                                 color='red', linestyle='--', alpha=0.7, label="Marker")
+        else:
+            beat_grid.set_interval(interval)
 
         # Ridisegna il grafico
         ax.legend(loc="upper right")  # Posiziona la legenda in alto a destra
-        canvas.draw()
+        canvas.draw_idle()
 
         # Mostra e abilita il tasto Adjust
-        adjust_button.pack(pady=10)
+        adjust_button.pack(pady=10, before=export_button)
         adjust_button.configure(state="normal")
 
         # Abilita il tasto preview
@@ -190,141 +274,84 @@ def update_markers():
     except Exception as e:
         print(f"Errore durante l'aggiornamento dei marker: {e}")
 
-def crossfade_segments(seg1, seg2, fade_length=100):
-    """Applica un crossfade tra due segmenti audio."""
-    if len(seg1) < fade_length or len(seg2) < fade_length:
-        raise ValueError("I segmenti devono essere più lunghi del fade_length")
-
-    # Converti a float64 per evitare problemi con il tipo di dato
-    seg1 = seg1.astype(np.float64)
-    seg2 = seg2.astype(np.float64)
-
-    # Crea una transizione graduale (fade-in e fade-out)
-    fade_in = np.linspace(0, 1, fade_length)
-    fade_out = np.linspace(1, 0, fade_length)
-
-    # Applica il fade-out al segmento precedente
-    seg1[-fade_length:] = seg1[-fade_length:] * fade_out
-
-    # Applica il fade-in al segmento successivo
-    seg2[:fade_length] = seg2[:fade_length] * fade_in
-
-    # Combina i due segmenti con un crossfade
-    combined = np.concatenate((seg1[:-fade_length], seg1[-fade_length:] + seg2[:fade_length], seg2[fade_length:]))
-
-    # Converti di nuovo a int16 prima di restituire
-    return combined.astype(np.int16)
-
 def adjust_audio():
-    """Rielabora il segnale audio e aggiorna la linea verde nel grafico."""
-    global adjusted_audio
+    """Avvia la rielaborazione in background; una nuova richiesta annulla quella in corso."""
     if not selected_file or selected_range is None:
         print("File non selezionato o range non definito.")
         return
 
     try:
-        # Ricarica il segnale originale dal file selezionato
-        with wave.open(selected_file, 'r') as wav_file:
-            n_frames = wav_file.getnframes()
-            framerate = wav_file.getframerate()
-            frames = wav_file.readframes(n_frames)
-            waveform = np.frombuffer(frames, dtype=np.int16)
-
-        # Considera solo i frame nell'arco temporale selezionato
-        start_time = selected_range[0]  # Inizio del range selezionato (in secondi)
-        end_time = selected_range[1]    # Fine del range selezionato (in secondi)
-        start_frame = int(start_time * framerate)  # Converti in frame
-        end_frame = int(end_time * framerate)      # Converti in frame
-        waveform = waveform[start_frame:end_frame]  # Isola la parte di audio selezionata
-
-        # Trova i marker BPM
         bpm = int(bpm_entry.get())
+    except ValueError:
+        print("Inserisci un valore numerico valido per il BPM.")
+        return
+
+    # I parametri si leggono qui, nel thread di Tk; il lavoro riceve solo valori
+    document = open_document(selected_file)
+    amplitude_range, phase = selected_range, beat_phase
+    engine_label = engine_menu.get()
+    engine = STRETCH_ENGINES[engine_label]
+    state = (bpm, amplitude_range, engine_label, True)
+
+    # Un risultato recente (per esempio dopo annulla/ripeti) si mostra senza rielaborare
+    key = (document.path, document.signature, phase, state)
+    if key in render_cache:
+        worker.cancel('adjust')
+        render_cache.move_to_end(key)
+        show_adjusted(render_cache[key])
+        return
+
+    def render(progress):
+        # Allinea i picchi fuori dal range di ampiezza selezionato ai marker BPM
+        # I picchi del file si cercano al primo Adjust; BPM e range successivi filtrano l'indice
+        peak_index = document.derived('peak_index', lambda: PeakIndex(document.samples, document.framerate))
+        # Dall'ultimo rendering si ricalcola solo il tratto in cui la mappa temporale è cambiata
+        warp_cache = document.derived('warp_cache', dict)
+        adjusted = adjust_waveform(document.samples, document.framerate, bpm, amplitude_range, phase,
+                                   engine, progress, peak_index, warp_cache, quality=PREVIEW_QUALITY)
+        # adjusted è int16 a fondo scala 32767: per le sorgenti float32 (fondo scala 1.0) la piramide
+        # si riporta nelle stesse unità dell'originale, così le due curve e il range di ampiezza si confrontano
+        shown = adjusted if document.samples.dtype == adjusted.dtype else adjusted.astype('float32') / 32768
+        return key, document, adjusted, WaveformPyramid(shown, document.framerate)
+
+    message_label.configure(text="Adjust in corso...")
+    worker.submit(
+        'adjust', render, on_done=show_adjusted,
+        on_error=lambda e: print(f"Errore durante l'operazione di Adjust: {e}"),
+        on_progress=lambda fraction: message_label.configure(text=f"Adjust in corso... {fraction:.0%}")
+    )
+
+@timed('show adjusted')
+def show_adjusted(result):
+    """Nel thread di Tk: mostra l'ultimo Adjust completato e aggiorna la linea verde nel grafico."""
+    global adjusted_audio, adjusted_key, beat_grid
+    try:
+        key, document, adjusted_audio, adjusted_pyramid = result
+        adjusted_key = key
+        export_button.configure(state="normal")
+        render_cache[key] = result
+        while len(render_cache) > RENDER_CACHE_SIZE:
+            render_cache.popitem(last=False)
+        state = key[-1]
+        bpm = state[0]
         interval = 60 / bpm  # Intervallo tra i marker in secondi
-        duration = len(waveform) / framerate
-        marker_positions = np.array(np.arange(0, duration, interval) * framerate, dtype=int)
-
-        # Trova i picchi nel segnale audio
-        peaks, _ = find_peaks(waveform, height=np.max(waveform) * 0.5, distance=framerate * interval / 2)
-
-        # Filtra i picchi rilevanti
-        ymin, ymax = selected_range
-        relevant_peaks = peaks[(peaks >= start_frame) & (peaks <= end_frame) & 
-                               ((waveform[peaks] < ymin) | (waveform[peaks] > ymax))]
-
-        # Crea una mappa dei picchi non rilevanti
-        non_relevant_peaks = set(peaks) - set(relevant_peaks)
-
-        # Elabora i segmenti tra i marker
-        adjusted_segments = []  # Per accumulare i segmenti rielaborati
-        previous_marker = 0  # Partenza iniziale del primo segmento
-        for i in range(len(marker_positions)):
-            current_marker = marker_positions[i]
-            next_marker = marker_positions[i + 1] if i + 1 < len(marker_positions) else len(waveform)
-
-            # Trova i picchi nel range temporale tra il marker precedente e quello successivo
-            segment_peaks = relevant_peaks[(relevant_peaks >= previous_marker) & (relevant_peaks < next_marker)]
-            if len(segment_peaks) > 0:
-                # Trova il picco più vicino al marker corrente (in termini assoluti)
-                closest_peak = segment_peaks[np.argmin(np.abs(segment_peaks - current_marker))]
-            else:
-                # Se non ci sono picchi, usa un'interpolazione morbida per evitare clic
-                interp_waveform = np.linspace(
-                    waveform[previous_marker],
-                    waveform[next_marker - 1],
-                    next_marker - previous_marker
-                )
-                adjusted_segments.append(interp_waveform)
-                previous_marker = next_marker
-                continue
-
-            # Sposta il picco rilevante esattamente sul marker corrente
-            offset = current_marker - closest_peak
-            shifted_waveform = np.roll(waveform[previous_marker:next_marker], offset)
-
-            # Comprime o allunga i segmenti per adattarli alla durata tra i marker
-            target_length = next_marker - previous_marker
-            resampled_segment = resample(shifted_waveform, target_length)
-
-            # Mantieni i picchi non rilevanti nella loro posizione originale
-            for non_rel_peak in non_relevant_peaks:
-                if previous_marker <= non_rel_peak < next_marker:
-                    original_position = non_rel_peak - previous_marker
-                    resampled_segment[original_position] = waveform[non_rel_peak]
-
-            # Accumula il segmento rielaborato
-            adjusted_segments.append(resampled_segment)
-            previous_marker = next_marker
-
-        # Ricostruisce il segnale completo
-        adjusted_audio = np.concatenate(adjusted_segments).astype(np.float64)
-
-        # Applica normalizzazione
-        adjusted_audio = adjusted_audio / np.max(np.abs(adjusted_audio)) * 32767
-
-        # Applica un fade-out alla fine del segnale
-        fade_out_length = int(0.05 * framerate)  # 50 ms di fade-out
-        fade_out = np.linspace(1, 0, fade_out_length)
-        adjusted_audio[-fade_out_length:] *= fade_out
-
-        # Converti a int16
-        adjusted_audio = adjusted_audio.astype(np.int16)
+        if playback.active:
+            update_playback_source()  # Sostituisce l'audio in riproduzione senza fermarla
 
         # Aggiorna il grafico
         ax = canvas.figure.axes[0]
         ax.cla()  # Cancella l'asse corrente
 
         # Mostra la forma d'onda originale
-        duration = n_frames / framerate
-        time = np.linspace(0, duration, num=n_frames)
-        ax.plot(time, np.frombuffer(frames, dtype=np.int16), color='orange', label="Forma d'onda originale")
+        WaveformView(ax, document.pyramid(), color='orange', label="Forma d'onda originale")
 
         # Mostra la forma d'onda rielaborata (solo UNA verde)
-        adjusted_time = np.linspace(0, duration, num=len(adjusted_audio))
-        ax.plot(adjusted_time, adjusted_audio, color='green', alpha=0.6, label="Forma d'onda rielaborata")
+        WaveformView(ax, adjusted_pyramid, color='green', alpha=0.6, label="Forma d'onda rielaborata")
 
         # Ridisegna i marker
-        for t in marker_positions / framerate:  # Converti in secondi
-            ax.axvline(x=t, color='red', linestyle='--', alpha=0.7, label="Marker")
+        beat_grid = BeatGrid(ax, interval, document.duration, offset=beat_phase,
+                             color='red', linestyle='--', alpha=0.7, label="Marker")
+        ax.callbacks.connect('xlim_changed', lambda axes: update_loop())
 
         # Configura la legenda fuori dal grafico
         ax.legend(
@@ -335,23 +362,51 @@ def adjust_audio():
         )
 
         canvas.draw()
+        history.push(state)
+        update_history_buttons()
+        message_label.configure(text="Adjust completato.")
         print("Adjust completato.")
     except Exception as e:
         print(f"Errore durante l'operazione di Adjust: {e}")
 
+def export_audio():
+    """Rielabora l'ultimo Adjust con il ricampionamento di qualità massima e lo salva in WAV a 16 bit."""
+    if adjusted_audio is None or adjusted_key is None:
+        print("Esegui Adjust prima di esportare.")
+        return
+    file_path = ctk.filedialog.asksaveasfilename(defaultextension=".wav", filetypes=[("WAV files", "*.wav")])
+    if not file_path:
+        return
+    document = open_document(selected_file)
+    _, _, phase, (bpm, amplitude_range, engine_label, _) = adjusted_key
+
+    def render(progress):
+        peak_index = document.derived('peak_index', lambda: PeakIndex(document.samples, document.framerate))
+        warp_cache = document.derived('warp_cache', dict)
+        exported = adjust_waveform(document.samples, document.framerate, bpm, amplitude_range, phase,
+                                   STRETCH_ENGINES[engine_label], progress, peak_index, warp_cache,
+                                   quality=EXPORT_QUALITY)
+        write_wav(file_path, exported, document.framerate, document.n_channels)
+        return file_path
+
+    def exported(path):
+        message_label.configure(text=f"Esportato in {path}")
+        print(f"File esportato: {path}")
+
+    message_label.configure(text="Esportazione in corso...")
+    worker.submit(
+        'export', render, on_done=exported,
+        on_error=lambda e: print(f"Errore durante l'esportazione: {e}"),
+        on_progress=lambda fraction: message_label.configure(text=f"Esportazione in corso... {fraction:.0%}")
+    )
+
+@timed('plot')
 def visualize_waveform(file_path):
-    """Carica il file .wav e rappresenta la forma d'onda con divisioni di tempo basate sui BPM."""
-    global canvas
-    # Leggere i dati dal file .wav
-    with wave.open(file_path, 'r') as wav_file:
-        n_frames = wav_file.getnframes()
-        n_channels = wav_file.getnchannels()
-        framerate = wav_file.getframerate()
-        duration = n_frames / float(framerate)
-        frames = wav_file.readframes(n_frames)
-        waveform = np.frombuffer(frames, dtype=np.int16)
-        if n_channels == 2:
-            waveform = waveform[::2]
+    """Carica il file audio e rappresenta la forma d'onda con divisioni di tempo basate sui BPM."""
+    global canvas, beat_grid
+    # Leggere i dati dal documento condiviso
+    document = open_document(file_path)
+    duration = document.duration
 
     # Creare il grafico
     fig, ax = plt.subplots(figsize=(8, 4))
@@ -360,20 +415,14 @@ def visualize_waveform(file_path):
     for spine in ax.spines.values():
         spine.set_edgecolor('white')  # Colore dei bordi
 
-    time = np.linspace(0, duration, num=len(waveform))
-    ax.plot(time, waveform, color='orange', label="Forma d'onda originale")
+    WaveformView(ax, document.pyramid(), color='orange', label="Forma d'onda originale")
 
     # Aggiungere linee verticali per i BPM
     try:
         bpm = int(bpm_entry.get())
         interval = 60 / bpm  # Intervallo in secondi
-        first_marker = True  # Per aggiungere la label una sola volta
-        for t in np.arange(0, duration, interval):
-            if first_marker:
-                ax.axvline(x=t, color='red', linestyle='--', alpha=0.7, label="Marker")
-                first_marker = False
-            else:
-                ax.axvline(x=t, color='red', linestyle='--', alpha=0.7)
+        beat_grid = BeatGrid(ax, interval, duration, offset=beat_phase,
+                             color='red', linestyle='--', alpha=0.7, label="Marker")
 
         ax.set_title("Forma d'onda con marker BPM", color='orange')
         ax.set_xlabel("Tempo (s)", color='orange')
@@ -397,6 +446,9 @@ def visualize_waveform(file_path):
     # Visualizzare il grafico in customtkinter
     canvas = FigureCanvasTkAgg(fig, master=graph_frame)
     canvas.get_tk_widget().pack(fill='both', expand=True)
+    instrument_canvas(canvas)
+    canvas.mpl_connect("button_press_event", seek_playback)
+    ax.callbacks.connect('xlim_changed', lambda axes: update_loop())  # Il loop segue la vista
     canvas.draw()
 
     # Abilita il selettore per scegliere il range
@@ -406,9 +458,70 @@ def visualize_waveform(file_path):
 def delayed_update_bpm(*args):
     """Gestisce l'aggiornamento del grafico e rilancia Adjust quando cambia il BPM."""
     global update_delay
+    update_markers()
     if update_delay is not None:
         root.after_cancel(update_delay)  # Cancella eventuali timer in corso
+    if adjusted_audio is None and not worker.busy('adjust'):
+        update_delay = root.after(300, record_state)  # Nessun Adjust da aggiornare: registra solo il BPM
+        return
     update_delay = root.after(300, adjust_audio)  # Rilancia adjust_audio con il nuovo BPM
+
+def current_state():
+    """Stato modificabile dall'utente; None se il BPM inserito non è valido."""
+    try:
+        bpm = int(bpm_entry.get())
+    except ValueError:
+        return None
+    return bpm, selected_range, engine_menu.get(), adjusted_audio is not None
+
+def record_state():
+    """Aggiunge lo stato corrente alla cronologia dopo una modifica."""
+    state = current_state()
+    if selected_file and state is not None:
+        history.push(state)
+        update_history_buttons()
+
+def restore_state(state):
+    """Ripristina uno stato della cronologia; l'Adjust viene preso dalla cache o rielaborato."""
+    global selected_range, adjusted_audio
+    bpm, selected_range, engine_label, adjusted = state
+    bpm_entry.delete(0, ctk.END)
+    bpm_entry.insert(0, str(bpm))
+    engine_menu.set(engine_label)
+    if adjusted:
+        adjust_audio()
+    else:
+        worker.cancel('adjust')
+        adjusted_audio = None
+        export_button.configure(state="disabled")
+        visualize_waveform(selected_file)
+        if playback.active:
+            update_playback_source()
+    update_history_buttons()
+
+def save_current_session():
+    """Salva accanto al file aperto tempo rilevato, cronologia e analisi, per riaprirlo all'istante."""
+    if not selected_file or detected_tempo is None:
+        return
+    try:
+        save_session(open_document(selected_file), SESSION_APP,
+                     {'tempo': detected_tempo, 'history': history.snapshot()})
+    except Exception as e:
+        print(f"Errore durante il salvataggio della sessione: {e}")
+
+def undo(event=None):
+    state = history.undo()
+    if state is not None:
+        restore_state(state)
+
+def redo(event=None):
+    state = history.redo()
+    if state is not None:
+        restore_state(state)
+
+def update_history_buttons():
+    undo_button.configure(state="normal" if history.can_undo() else "disabled")
+    redo_button.configure(state="normal" if history.can_redo() else "disabled")
     
 def update_bpm():
     """Aggiorna le linee verticali del grafico quando cambia il BPM."""
@@ -424,6 +537,9 @@ root = ctk.CTk()
 root.title("Visualizzatore di Forma d'Onda")
 root.geometry("1000x600")
 
+# Thread di lavoro per caricamento, rilevamento BPM e Adjust
+worker = BackgroundWorker(root)
+
 main_frame = ctk.CTkFrame(root, fg_color="#2E2E2E")
 main_frame.pack(fill="both", expand=True, padx=20, pady=20)
 
@@ -431,12 +547,26 @@ main_frame.pack(fill="both", expand=True, padx=20, pady=20)
 control_frame = ctk.CTkFrame(main_frame, fg_color="#2E2E2E")
 control_frame.pack(side="left", fill="y", padx=20)
 
-select_button = ctk.CTkButton(control_frame, text="Seleziona file WAV", command=select_file)
+select_button = ctk.CTkButton(control_frame, text="Seleziona file audio", command=select_file)
 select_button.pack(pady=(20, 10))
 
 preview_button = ctk.CTkButton(control_frame, text="Preview", command=preview_file, state="disabled")
 preview_button.pack(pady=(0, 10))
 
+# Loop sull'intervallo visibile e posizione di riproduzione (click destro sul grafico per spostarla)
+loop_checkbox = ctk.CTkCheckBox(control_frame, text="Loop vista", command=update_loop)
+loop_checkbox.pack(pady=(0, 5))
+playhead_label = ctk.CTkLabel(control_frame, text="")
+playhead_label.pack(pady=(0, 10))
+
+# Annulla/ripeti per BPM e Adjust (anche con Ctrl+Z / Ctrl+Y)
+undo_button = ctk.CTkButton(control_frame, text="Annulla", command=undo, state="disabled")
+undo_button.pack(pady=(0, 5))
+redo_button = ctk.CTkButton(control_frame, text="Ripeti", command=redo, state="disabled")
+redo_button.pack(pady=(0, 10))
+root.bind("<Control-z>", undo)
+root.bind("<Control-y>", redo)
+
 bpm_frame = ctk.CTkFrame(control_frame, fg_color="#2E2E2E")
 bpm_frame.pack(pady=(10, 5), anchor="w")
 
@@ -447,17 +577,30 @@ bpm_entry = ctk.CTkEntry(bpm_frame, width=100)
 bpm_entry.insert(0, "100")  # Valore predefinito
 bpm_entry.pack(side="right")
 # Associa l'aggiornamento dei marker al cambio del controllo BPM
-bpm_entry.bind("<KeyRelease>", lambda event: update_markers())
+bpm_entry.bind("<KeyRelease>", delayed_update_bpm)
+
+# Motore usato da Adjust per spostare i picchi
+engine_menu = ctk.CTkOptionMenu(control_frame, values=list(STRETCH_ENGINES))
+engine_menu.set("Resample")
+engine_menu.pack(pady=(10, 0))
 
 # Associa l'esecuzione di adjust_audio al pulsante "Adjust"
 adjust_button = ctk.CTkButton(control_frame, text="Adjust", command=adjust_audio)
 adjust_button.pack(pady=10)
 adjust_button.pack_forget()  # Nascondi finché non è caricato un file
 
+# Salva l'ultimo Adjust rielaborato con il ricampionamento di qualità massima
+export_button = ctk.CTkButton(control_frame, text="Esporta WAV", command=export_audio, state="disabled")
+export_button.pack(pady=(0, 10))
+
 # Frame per il grafico
 graph_frame = ctk.CTkFrame(main_frame, fg_color="#2E2E2E")
 graph_frame.pack(side="left", fill="both", expand=True)
 
+# Tempi delle fasi sopra il grafico (F12); UFFADUEVOLTE_TRACE=file.json li esporta alla chiusura
+timing_overlay = TimingOverlay(root, graph_frame)
+root.bind("<F12>", timing_overlay.toggle)
+
 # Messaggio per guidare l'utente sotto il grafico
 message_label = ctk.CTkLabel(graph_frame, text="", text_color="orange")
 message_label.pack(side="bottom", pady=(10, 5))  # Posizionato sotto il grafico
@@ -466,4 +609,13 @@ message_label.pack(side="bottom", pady=(10, 5))  # Posizionato sotto il grafico
 adjust_button.configure(state="disabled")
 
 # Avvio applicazione
+def on_close():
+    """Annulla i lavori in background e ferma la riproduzione prima di chiudere."""
+    worker.shutdown()
+    playback.stop()
+    save_current_session()
+    save_trace()
+    root.destroy()
+
+root.protocol("WM_DELETE_WINDOW", on_close)
 root.mainloop()
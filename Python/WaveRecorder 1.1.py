@@ -2,13 +2,19 @@ import customtkinter as ctk
 from tkinter import filedialog
 import sounddevice as sd
 import soundfile as sf
-import threading
-import numpy as np
+import gc
 import os
-import shutil
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.widgets import SpanSelector
+from audio_document import close_document, open_document
+from edit_list import EditList, EditedAudio, EditedPyramid, render_edits
+from history import History
+from live_levels import LevelHistory
+from playback import PlaybackEngine
+from profiling import TimingOverlay, instrument_canvas, save_trace, timed
+from recording_writer import RecordingWriter
+from waveform_view import LiveWaveformView, WaveformView
 
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
@@ -22,6 +28,12 @@ class AudioRecorderApp:
 
         self.recording = False
         self.sample_rate = 44100
+        self.flush_interval = 1.0  # Secondi tra due scritture forzate del file temporaneo
+        self.stream = None  # InputStream attivo durante la registrazione
+        self.writer = None  # Thread che scrive i blocchi registrati nel file temporaneo
+        self.live_fps = 20  # Aggiornamenti al secondo della vista dal vivo
+        self.levels = None  # Storico min/max/RMS scritto dalla callback di registrazione
+        self.live_view = None  # Forma d'onda scorrevole mostrata durante la registrazione
 
         self.temp_dir = "C:/Temp"
         self.temp_file_path = os.path.join(self.temp_dir, "temp_recording.wav")
@@ -32,9 +44,16 @@ class AudioRecorderApp:
         self.trim_start = None
         self.trim_end = None
 
+        self.source_audio = None  # Campioni (frames, canali) della registrazione, mappati dal file e mai modificati
+        self.edits = None  # Montaggio non distruttivo della registrazione (EditList)
+        self.history = History()  # Montaggi precedenti, che condividono i segmenti con quello corrente
+        self.playback = PlaybackEngine()  # Motore di riproduzione condiviso con gli stretcher
+
         self.create_widgets()
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
 
     def create_widgets(self):
         padding = 15
@@ -65,6 +84,12 @@ class AudioRecorderApp:
         self.trim_confirm_button = ctk.CTkButton(self.button_frame, text="Confirm Cut", command=self.confirm_trim, width=button_width)
         self.trim_confirm_button.pack_forget()
 
+        self.undo_button = ctk.CTkButton(self.button_frame, text="Undo", command=self.undo, width=button_width)
+        self.undo_button.pack_forget()
+
+        self.redo_button = ctk.CTkButton(self.button_frame, text="Redo", command=self.redo, width=button_width)
+        self.redo_button.pack_forget()
+
         self.message_label = ctk.CTkLabel(
             self.button_frame, text="",
             font=ctk.CTkFont(size=14), text_color="#FFA500",
@@ -72,6 +97,13 @@ class AudioRecorderApp:
         )
         self.message_label.pack(fill="x", pady=(padding, 5))
 
+        self.playhead_label = ctk.CTkLabel(
+            self.button_frame, text="",
+            font=ctk.CTkFont(size=14), text_color="#FFA500",
+            anchor="w"
+        )
+        self.playhead_label.pack(fill="x", pady=(0, 5))
+
         self.graph_frame = ctk.CTkFrame(self.main_frame, fg_color="#2E2E2E")
         self.graph_frame.pack(side="left", fill="both", expand=True, padx=padding)
 
@@ -83,6 +115,11 @@ class AudioRecorderApp:
 
         self.canvas = FigureCanvasTkAgg(self.figure, master=self.graph_frame)
         self.canvas.get_tk_widget().pack(fill='both', expand=True)
+        instrument_canvas(self.canvas)
+
+        # Tempi delle fasi sopra il grafico (F12); UFFADUEVOLTE_TRACE=file.json li esporta alla chiusura
+        self.timing_overlay = TimingOverlay(self.root, self.canvas.get_tk_widget())
+        self.root.bind("<F12>", self.timing_overlay.toggle)
 
         self.span_selector = SpanSelector(self.ax, self.on_select, 'horizontal', useblit=True)
 
@@ -93,43 +130,82 @@ class AudioRecorderApp:
             self.preview_button.pack_forget()
             self.save_button.pack_forget()
             self.trim_confirm_button.pack_forget()
+            self.undo_button.pack_forget()
+            self.redo_button.pack_forget()
         else:
             self.stop_recording()
             self.record_button.configure(text="Start")
             if os.path.exists(self.temp_file_path):
                 self.preview_button.pack(pady=5, anchor="w")
                 self.save_button.pack(pady=5, anchor="w")
+                self.undo_button.pack(pady=5, anchor="w")
+                self.redo_button.pack(pady=5, anchor="w")
+                self.update_history_buttons()
 
     def start_recording(self):
+        self.release_temp_file()
+        # I blocchi vanno direttamente su disco: la memoria non cresce con la durata
+        self.writer = RecordingWriter(self.temp_file_path, self.sample_rate, channels=1,
+                                      flush_interval=self.flush_interval)
+        self.start_live_view()
         self.recording = True
-        self.audio_data = []
-        self.clear_plot()
-        threading.Thread(target=self.record_audio).start()
+        self.stream = sd.InputStream(samplerate=self.sample_rate, channels=1, callback=self.audio_callback)
+        self.stream.start()
         self.message_label.configure(text="Recording started.")
+        self.refresh_live_view()
 
-    def record_audio(self):
-        with sd.InputStream(samplerate=self.sample_rate, channels=1, callback=self.audio_callback):
-            while self.recording:
-                sd.sleep(100)
+    def start_live_view(self):
+        # Vista scorrevole degli ultimi secondi, con costo di disegno costante
+        self.levels = LevelHistory(self.sample_rate)
+        self.ax.clear()
+        self.ax.set_facecolor('#2E2E2E')
+        self.ax.set_title('Recording', color='orange')
+        self.ax.set_xlabel('Time (s)', color='orange')
+        self.ax.set_ylabel('Amplitude', color='orange')
+        self.ax.tick_params(axis='x', colors='orange')
+        self.ax.tick_params(axis='y', colors='orange')
+        self.live_view = LiveWaveformView(self.ax, self.levels, color='orange')
+        self.canvas.draw()
+
+    @timed('live view')
+    def refresh_live_view(self):
+        # Aggiornamento a frequenza fissa, indipendente dalla dimensione dei blocchi audio
+        if not self.recording:
+            return
+        self.live_view.update()
+        self.root.after(int(1000 / self.live_fps), self.refresh_live_view)
+
+    def stop_live_view(self):
+        if self.live_view is not None:
+            self.live_view.disconnect()
+            self.live_view = None
 
     def audio_callback(self, indata, frames, time, status):
         if status:
             print(status)
         if self.recording:
-            self.audio_data.append(indata.copy())
+            self.writer.put(indata.copy())
+            self.levels.add(indata)
 
     def stop_recording(self):
         if self.recording:
             self.recording = False
-            self.message_label.configure(text="Recording stopped.")
-            self.save_temp_file()
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+            try:
+                self.writer.close()  # Scrive solo i pochi blocchi ancora in coda
+                self.message_label.configure(text="Recording stopped.")
+            except Exception as e:
+                self.message_label.configure(text=f"Error while writing the recording: {str(e)}")
+            self.writer = None
+            self.edits = EditList.whole(sf.info(self.temp_file_path).frames)  # Nessun taglio
+            self.history.reset(self.edits)
+            if self.levels.clipped:
+                self.message_label.configure(text="Recording stopped. Clipping detected: lower the input level.")
+            self.stop_live_view()
             self.plot_waveform()
 
-    def save_temp_file(self):
-        if hasattr(self, 'audio_data') and self.audio_data:
-            audio_array = np.concatenate(self.audio_data, axis=0)
-            sf.write(self.temp_file_path, audio_array, self.sample_rate)
-
     def save_recording(self):
         if not os.path.exists(self.temp_file_path):
             self.message_label.configure(text="No recording to save. Please record audio first.")
@@ -137,11 +213,24 @@ class AudioRecorderApp:
 
         file_path = filedialog.asksaveasfilename(defaultextension=".wav", filetypes=[("WAV files", "*.wav")])
         if file_path:
-            shutil.copy(self.temp_file_path, file_path)
+            # Il montaggio viene scritto solo ora, a blocchi, direttamente nel file scelto
+            render_edits(self.temp_file_path, self.edits, file_path)
             self.message_label.configure(text=f"Recording saved as {file_path}")
             self.clean_temp_file()
+            self.canvas.draw()
+
+    def release_temp_file(self):
+        # Prima di riscrivere o cancellare il file temporaneo la mappatura va chiusa (su Windows altrimenti
+        # fallisce). Resta aperta finché qualcuno ne tiene i campioni: la sorgente della riproduzione
+        # (EditedAudio), la vista sugli assi (WaveformView -> EditedPyramid -> piramide) e il documento
+        self.playback.clear_source()
+        self.ax.clear()  # Rimuove anche la callback xlim_changed che tiene viva la vista
+        self.source_audio = None
+        close_document(self.temp_file_path)
+        gc.collect()  # Libera subito la mappatura anche se è rimasta in un ciclo di riferimenti
 
     def clean_temp_file(self):
+        self.release_temp_file()
         if os.path.exists(self.temp_file_path):
             os.remove(self.temp_file_path)
 
@@ -150,53 +239,42 @@ class AudioRecorderApp:
             self.message_label.configure(text="No recording to preview. Please record audio first.")
             return
         try:
-            # Leggi il file audio
-            audio_array, samplerate = sf.read(self.temp_file_path, dtype='float32')
-            if audio_array.ndim == 2 and audio_array.shape[1] == 1:
-                audio_array = audio_array[:, 0]
-
             # Validazione: Controlla se trim_start o trim_end sono None
             if self.trim_start is None or self.trim_end is None:
                 self.message_label.configure(text="Trim range not selected. Please select a valid range.")
                 return
 
             # Validazione: Assicurati che trim_start e trim_end siano validi
-            self.trim_start = max(0, min(self.trim_start, len(audio_array)))
-            self.trim_end = max(0, min(self.trim_end, len(audio_array)))
-
-            # Determina la parte audio da riprodurre
-            if self.trim_start == 0:
-                preview_audio = audio_array[self.trim_end:]  # Solo la parte dopo il taglio
-            elif self.trim_end >= len(audio_array):
-                preview_audio = audio_array[:self.trim_start]  # Solo la parte prima del taglio
-            else:
-                preview_audio = np.concatenate((audio_array[:self.trim_start], audio_array[self.trim_end:]))  # Parti valide
-
-            # Salva il file temporaneo per la preview
-            preview_file_path = os.path.join(self.temp_dir, "temp_preview.wav")
-            sf.write(preview_file_path, preview_audio, samplerate)
-
-            # Riproduci il file temporaneo
-            sd.stop()
-            sd.play(preview_audio.copy(), samplerate=samplerate)
+            length = self.edits.n_frames
+            self.trim_start = max(0, min(self.trim_start, length))
+            self.trim_end = max(0, min(self.trim_end, length))
+
+            # Anteprima del montaggio con il taglio selezionato, letta dalla registrazione senza copiarla
+            preview_edits = self.edits.cut(self.trim_start, self.trim_end)
+            self.load_pyramid()
+            self.playback.set_source(EditedAudio(self.source_audio, preview_edits), self.sample_rate)
+            self.playback.play(0)
             self.message_label.configure(text="Playing preview...")
+            self.update_playhead()
 
-            print(f"Trim Start: {self.trim_start}, Trim End: {self.trim_end}, Audio Length: {len(audio_array)}")    
+            print(f"Trim Start: {self.trim_start}, Trim End: {self.trim_end}, Audio Length: {length}")
 
         except Exception as e:
             self.message_label.configure(text=f"Error during playback: {str(e)}")
 
+    def update_playhead(self):
+        # Mostra la posizione di riproduzione finché la preview è in corso
+        self.playhead_label.configure(text=f"{self.playback.position:.1f} / {self.playback.duration:.1f} s")
+        if self.playback.active:
+            self.root.after(50, self.update_playhead)
+
+    @timed('plot')
     def plot_waveform(self):
         self.ax.clear()
         if not os.path.exists(self.temp_file_path):
             self.ax.set_title('No audio data to display', color='orange')
         else:
-            audio_array, _ = sf.read(self.temp_file_path, dtype='float32')
-            if audio_array.ndim == 2 and audio_array.shape[1] == 1:
-                audio_array = audio_array[:, 0]
-
-            time_axis = np.linspace(0, len(audio_array) / self.sample_rate, num=len(audio_array))
-            self.ax.plot(time_axis, audio_array, color='orange')
+            WaveformView(self.ax, EditedPyramid(self.load_pyramid(), self.edits), color='orange')
 
             if (self.trim_start is not None) and (self.trim_end is not None) and (self.trim_end > self.trim_start):
                 self.ax.axvspan(
@@ -214,6 +292,13 @@ class AudioRecorderApp:
         self.ax.tick_params(axis='y', colors='orange')
         self.canvas.draw()
 
+    def load_pyramid(self):
+        # Il file temporaneo viene mappato in memoria (nessuna copia dei campioni) e la piramide
+        # si ricalcola solo se il file è cambiato, cioè dopo una nuova registrazione: i tagli non lo modificano
+        document = open_document(self.temp_file_path)
+        self.source_audio = document.samples
+        return document.pyramid()
+
     def clear_plot(self):
         self.ax.clear()
         self.canvas.draw()
@@ -227,32 +312,23 @@ class AudioRecorderApp:
 
     def confirm_trim(self):
         if self.trim_start is not None and self.trim_end is not None:
-            audio_array, _ = sf.read(self.temp_file_path, dtype='float32')
-
-            if audio_array.ndim == 2 and audio_array.shape[1] == 1:
-                audio_array = audio_array[:, 0]
-
             # Validazione: Assicurati che trim_start e trim_end siano validi
-            self.trim_start = max(0, min(self.trim_start, len(audio_array)))
-            self.trim_end = max(0, min(self.trim_end, len(audio_array)))
+            length = self.edits.n_frames
+            self.trim_start = max(0, min(self.trim_start, length))
+            self.trim_end = max(0, min(self.trim_end, length))
 
-            if self.trim_start >= self.trim_end or self.trim_start >= len(audio_array):
+            if self.trim_start >= self.trim_end or self.trim_start >= length:
                 self.message_label.configure(text="Invalid trim range.")
                 return
 
-            if self.trim_start == 0:
-                new_audio = audio_array[self.trim_end:]
-            elif self.trim_end >= len(audio_array):
-                new_audio = audio_array[:self.trim_start]
-            else:
-                new_audio = np.concatenate((audio_array[:self.trim_start], audio_array[self.trim_end:]))
-
-            if new_audio.shape[0] == 0:
+            # Il taglio aggiorna solo la lista di montaggio: il file temporaneo resta intatto
+            new_edits = self.edits.cut(self.trim_start, self.trim_end)
+            if new_edits.n_frames == 0:
                 self.message_label.configure(text="Nothing left after trim.")
                 return
-
-            # Sostituisci il file originale con quello tagliato
-            sf.write(self.temp_file_path, new_audio, self.sample_rate)
+            self.edits = new_edits
+            self.history.push(new_edits)
+            self.update_history_buttons()
 
             self.trim_start = None
             self.trim_end = None
@@ -262,8 +338,39 @@ class AudioRecorderApp:
             self.message_label.configure(text="Trim confirmed and waveform updated.")
             self.trim_confirm_button.pack_forget()
 
+    def undo(self):
+        if self.recording:
+            return
+        edits = self.history.undo()
+        if edits is not None:
+            self.restore_edits(edits, "Cut undone.")
+
+    def redo(self):
+        if self.recording:
+            return
+        edits = self.history.redo()
+        if edits is not None:
+            self.restore_edits(edits, "Cut restored.")
+
+    def restore_edits(self, edits, message):
+        # Ripristina un montaggio della cronologia: nessun accesso al file temporaneo
+        self.edits = edits
+        self.trim_start = None
+        self.trim_end = None
+        self.trim_confirm_button.pack_forget()
+        self.plot_waveform()
+        self.update_history_buttons()
+        self.message_label.configure(text=message)
+
+    def update_history_buttons(self):
+        self.undo_button.configure(state="normal" if self.history.can_undo() else "disabled")
+        self.redo_button.configure(state="normal" if self.history.can_redo() else "disabled")
+
     def on_close(self):
+        self.stop_recording()
+        self.playback.stop()
         self.clean_temp_file()
+        save_trace()
         self.root.destroy()
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+"""Documento audio condiviso tra AudioStretcher e PeakStretcher.
+
+Il file viene decodificato una sola volta: tutti i gestori degli eventi
+chiedono il documento con open_document() e ricevono la stessa istanza finché
+il file su disco non cambia (dimensione o data di modifica). La cache è
+protetta da un lock, così i documenti si possono aprire anche dai thread di
+lavoro.
+
+La decodifica passa da soundfile: WAV a 16/24/32 bit interi o float, FLAC e
+MP3. I campioni hanno un formato canonico: int16 per i file PCM a 16 bit (o
+meno), float32 con fondo scala 1.0 per tutti gli altri. I WAV (anche RF64 oltre
+4 GB) già nel formato canonico vengono mappati in memoria direttamente dal file,
+senza copie. I formati compressi vengono decodificati una volta sola e salvati
+in CACHE_DIR come .npy, con il nome dato dall'hash del contenuto del file; le
+aperture successive li mappano in memoria senza decodificarli. Per non rileggere
+tutto il file a ogni apertura, l'hash viene ricordato per (percorso, dimensione,
+mtime) in CACHE_DIR/paths e ricalcolato solo se il file cambia. La cache occupa
+al massimo CACHE_LIMIT byte: oltre, si cancellano i .npy usati meno di recente;
+clear_cache() la svuota del tutto (o si può cancellare a mano la cartella).
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import soundfile as sf
+
+from profiling import span
+from waveform_pyramid import WaveformPyramid
+from wav_mmap import map_samples, read_layout
+
+CACHE_SIZE = 2  # Numero massimo di documenti tenuti in memoria
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "uffaduevolte")  # Campioni decodificati (.npy)
+HASH_INDEX_DIR = os.path.join(CACHE_DIR, "paths")  # Hash già calcolati, per percorso, dimensione e mtime
+CACHE_LIMIT = 4 << 30  # Byte massimi dei .npy in cache (i meno usati di recente vengono cancellati)
+COMPRESSED_FORMATS = ('MP3', 'FLAC', 'OGG')  # Formati la cui decodifica vale la pena di salvare
+INT16_SUBTYPES = ('PCM_16', 'PCM_S8', 'PCM_U8')  # Sottotipi letti come int16 senza perdita
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3')  # Estensioni proposte nelle finestre di selezione
+WAV_FORMATS = ('WAV', 'WAVEX', 'RF64')  # Formati che si possono mappare direttamente dal file
+HASH_BLOCK = 1 << 20  # Byte letti per volta nel calcolo dell'hash
+
+_documents = OrderedDict()  # Percorso assoluto -> AudioDocument
+_lock = threading.Lock()  # Protegge _documents
+
+
+def file_signature(path):
+    """Restituisce la firma (dimensione, mtime) usata per invalidare la cache."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class AudioDocument:
+    """Audio decodificato di un file con i dati derivati calcolati su richiesta."""
+
+    def __init__(self, path, samples, framerate, signature=None):
+        self.path = path
+        self.samples = samples  # Array (frames, canali), in sola lettura
+        self.samples.flags.writeable = False
+        self.framerate = framerate
+        self.n_frames, self.n_channels = samples.shape
+        self.duration = self.n_frames / framerate
+        self.signature = signature
+        self._derived = {}  # Cache dei dati derivati (piramide, picchi, ...)
+
+    def channel(self, index):
+        """Restituisce un singolo canale come vista, senza copie."""
+        return self.samples[:, index]
+
+    def derived(self, key, factory):
+        """Calcola un dato derivato una sola volta e lo riusa alle chiamate successive."""
+        if key not in self._derived:
+            self._derived[key] = factory()
+        return self._derived[key]
+
+    def cached(self, key):
+        """Dato derivato già calcolato, o None."""
+        return self._derived.get(key)
+
+    def provide(self, key, value):
+        """Installa un dato derivato calcolato altrove (per esempio letto da una sessione)."""
+        self._derived.setdefault(key, value)
+
+    def pyramid(self):
+        """Piramide min/max/RMS usata per disegnare la forma d'onda."""
+        return self.derived('pyramid', lambda: WaveformPyramid(self.samples, self.framerate))
+
+    def is_stale(self):
+        """True se il file su disco è cambiato dopo il caricamento."""
+        try:
+            return file_signature(self.path) != self.signature
+        except OSError:
+            return True
+
+
+class AudioInfo:
+    """Parametri del file letti dall'intestazione, senza decodificare i campioni."""
+
+    def __init__(self, framerate, n_channels, n_frames, format='WAV', subtype='PCM_16'):
+        self.framerate = framerate
+        self.n_channels = n_channels
+        self.n_frames = n_frames
+        self.duration = n_frames / framerate
+        self.format = format
+        self.subtype = subtype
+        # Formato canonico dei campioni decodificati
+        self.dtype = np.int16 if subtype in INT16_SUBTYPES else np.float32
+
+
+def read_info(path):
+    """Legge frequenza, canali, numero di frame e formato dall'intestazione del file."""
+    info = sf.info(path)
+    return AudioInfo(info.samplerate, info.channels, info.frames, info.format, info.subtype)
+
+
+def read_blocks(path, block_frames):
+    """Legge il file a blocchi di block_frames frame, come array (frames, canali) nel formato canonico."""
+    dtype = read_info(path).dtype
+    with sf.SoundFile(path) as audio_file:
+        while True:
+            block = audio_file.read(block_frames, dtype=dtype, always_2d=True)
+            if not len(block):
+                break
+            yield block
+
+
+def file_hash(path):
+    """Hash del contenuto del file, usato come nome dei campioni decodificati in cache."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_BLOCK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_hash(path, signature=None):
+    """Come file_hash, ma riusa l'hash calcolato l'ultima volta se percorso, dimensione e mtime non sono cambiati."""
+    signature = list(signature or file_signature(path))
+    key = os.path.abspath(path)
+    index_path = os.path.join(HASH_INDEX_DIR, f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.json")
+    try:
+        with open(index_path) as index_file:
+            entry = json.load(index_file)
+        if entry['path'] == key and entry['signature'] == signature:
+            return entry['hash']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = file_hash(path)
+    try:
+        os.makedirs(HASH_INDEX_DIR, exist_ok=True)
+        temporary_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w') as index_file:
+            json.dump({'path': key, 'signature': signature, 'hash': digest}, index_file)
+        os.replace(temporary_path, index_path)
+    except OSError as e:
+        print(f"Impossibile salvare l'indice della cache: {e}")
+    return digest
+
+
+def prune_cache(limit=CACHE_LIMIT, keep=None):
+    """Cancella i .npy usati meno di recente finché la cache non supera limit byte (keep non si cancella)."""
+    try:
+        entries = [entry for entry in os.scandir(CACHE_DIR) if entry.is_file() and entry.name.endswith('.npy')]
+    except OSError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)  # Dal più recente
+    total = 0
+    for entry in entries:
+        total += entry.stat().st_size
+        if total > limit and entry.path != keep:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass  # Per esempio ancora mappato da un documento aperto (Windows)
+
+
+def clear_cache():
+    """Svuota la cache di decodifica: campioni .npy e indice degli hash."""
+    prune_cache(limit=0)
+    try:
+        for entry in os.scandir(HASH_INDEX_DIR):
+            os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def decode(path, info=None):
+    """Decodifica l'intero file in un array (frames, canali) nel formato canonico."""
+    info = info or read_info(path)
+    with span('decode', format=info.format, subtype=info.subtype):
+        samples, _ = sf.read(path, dtype=info.dtype, always_2d=True)
+    return samples
+
+
+def map_wav(path, info):
+    """Mappa in memoria il chunk data di un WAV, o None se i campioni non sono nel formato canonico."""
+    with span('map wav'):
+        try:
+            layout = read_layout(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        if layout.dtype != info.dtype or layout.n_channels != info.n_channels:
+            return None  # Per esempio 24 bit o interi a 32 bit: vanno convertiti in float32
+        return map_samples(path, layout)
+
+
+def decode_cached(path, info=None):
+    """Come decode, ma senza copie quando possibile: WAV mappati dal file, formati compressi dalla cache."""
+    info = info or read_info(path)
+    if info.format in WAV_FORMATS:
+        samples = map_wav(path, info)
+        return samples if samples is not None else decode(path, info)
+    if info.format not in COMPRESSED_FORMATS:
+        return decode(path, info)
+
+    cache_path = os.path.join(CACHE_DIR, f"{cached_file_hash(path)}.npy")
+    if os.path.exists(cache_path):
+        with span('decode cache'):
+            try:
+                os.utime(cache_path)  # Usato di recente: è l'ultimo a essere cancellato da prune_cache
+            except OSError:
+                pass
+            return np.load(cache_path, mmap_mode='r')
+
+    samples = decode(path, info)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Scrittura atomica: un'altra apertura non vede mai un .npy scritto a metà
+        temporary_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'wb') as cache_file:
+            np.save(cache_file, samples)
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        print(f"Impossibile salvare la cache di decodifica: {e}")
+    prune_cache(keep=cache_path)
+    return samples
+
+
+def load_document(path):
+    """Decodifica un file audio (WAV, FLAC, MP3) in un nuovo AudioDocument."""
+    with span('load', file=os.path.basename(path)):
+        signature = file_signature(path)
+        info = read_info(path)
+        return AudioDocument(path, decode_cached(path, info), info.framerate, signature)
+
+
+def open_document(path):
+    """Restituisce il documento condiviso per il file, ricaricandolo solo se è cambiato."""
+    key = os.path.abspath(path)
+    with _lock:
+        document = _documents.get(key)
+    if document is None or document.is_stale():
+        document = load_document(path)  # Decodifica fuori dal lock: gli altri documenti restano disponibili
+    with _lock:
+        _documents[key] = document
+        _documents.move_to_end(key)
+        while len(_documents) > CACHE_SIZE:
+            _documents.popitem(last=False)
+    return document
+
+
+def close_document(path):
+    """Rimuove il documento dalla cache liberando la memoria."""
+    with _lock:
+        _documents.pop(os.path.abspath(path), None)
@@ -0,0 +1,126 @@
+"""Esecuzione in background delle operazioni lunghe, con annullamento e avanzamento.
+
+Ogni lavoro gira su un thread e riceve una funzione progress(frazione) da
+chiamare di tanto in tanto: se nel frattempo è arrivata una richiesta più
+recente con la stessa chiave, progress solleva Cancelled e il lavoro si
+interrompe al primo punto utile. Avanzamento, risultati ed errori tornano al
+thread di Tk attraverso una coda letta con root.after, e vengono consegnati
+solo per l'ultima richiesta di ogni chiave.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+POLL_INTERVAL = 30  # Millisecondi tra due letture della coda dei risultati
+MAX_WORKERS = 2  # Un lavoro superato può finire mentre parte quello nuovo
+
+
+class Cancelled(Exception):
+    """Sollevata da progress() quando il lavoro è stato superato o annullato."""
+
+
+class Task:
+    """Richiesta in corso: permette l'annullamento cooperativo e riporta l'avanzamento."""
+
+    def __init__(self, key, results):
+        self.key = key
+        self.results = results
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def progress(self, fraction):
+        """Da chiamare nel thread di lavoro: segnala l'avanzamento e interrompe se annullato."""
+        if self.cancelled:
+            raise Cancelled()
+        self.results.put((self, 'progress', fraction))
+
+
+class BackgroundWorker:
+    """Esegue funzioni lunghe fuori dal thread di Tk e ne consegna i risultati con root.after."""
+
+    def __init__(self, root, max_workers=MAX_WORKERS):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.results = queue.Queue()  # (task, tipo, valore) dai thread di lavoro
+        self.latest = {}  # Chiave -> ultimo Task richiesto
+        self.handlers = {}  # Task -> (on_done, on_error, on_progress)
+        self.poll_job = None
+
+    def submit(self, key, function, on_done=None, on_error=None, on_progress=None):
+        """Esegue function(progress) in background annullando la richiesta precedente con la stessa chiave.
+
+        I callback vengono chiamati nel thread di Tk: on_done(risultato),
+        on_error(eccezione) e on_progress(frazione).
+        """
+        self.cancel(key)
+        task = Task(key, self.results)
+        self.latest[key] = task
+        self.handlers[task] = (on_done, on_error, on_progress)
+        self.executor.submit(self._run, task, function)
+        self._schedule_poll()
+        return task
+
+    def cancel(self, key):
+        """Annulla l'ultima richiesta con la chiave indicata, se è ancora in corso."""
+        task = self.latest.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def busy(self, key):
+        return key in self.latest
+
+    def shutdown(self):
+        """Annulla tutti i lavori senza attendere la loro fine (da chiamare alla chiusura)."""
+        for key in list(self.latest):
+            self.cancel(key)
+        self.executor.shutdown(wait=False)
+
+    def _run(self, task, function):
+        try:
+            if task.cancelled:  # Superata mentre era in attesa di un thread libero
+                raise Cancelled()
+            result = function(task.progress)
+        except Cancelled:
+            self.results.put((task, 'cancelled', None))
+        except Exception as e:
+            self.results.put((task, 'error', e))
+        else:
+            self.results.put((task, 'done', result))
+
+    def _schedule_poll(self):
+        if self.poll_job is None:
+            self.poll_job = self.root.after(POLL_INTERVAL, self._poll)
+
+    def _poll(self):
+        self.poll_job = None
+        while True:
+            try:
+                task, kind, value = self.results.get_nowait()
+            except queue.Empty:
+                break
+            current = self.latest.get(task.key) is task
+            if kind == 'progress':
+                on_progress = self.handlers[task][2]
+                if current and on_progress is not None:
+                    on_progress(value)
+                continue
+
+            on_done, on_error, _ = self.handlers.pop(task)
+            if not current:
+                continue  # Risultato di una richiesta superata: non va mostrato
+            del self.latest[task.key]
+            if kind == 'done' and on_done is not None:
+                on_done(value)
+            elif kind == 'error':
+                if on_error is not None:
+                    on_error(value)
+                else:
+                    print(f"Errore in background ({task.key}): {value}")
+        if self.handlers:
+            self._schedule_poll()
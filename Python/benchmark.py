@@ -0,0 +1,279 @@
+"""Benchmark delle fasi DSP su tracce sintetiche a BPM noto.
+
+Genera tracce di click e di batteria (cassa, rullante, charleston) mono e
+stereo alle durate indicate, le scrive in WAV a 16 bit e misura per ogni fase
+tempo e picco di memoria allocata (tracemalloc): caricamento, rilevamento BPM,
+posizioni dei battiti, Adjust con lo spostamento per segmenti (resample) e con
+il time-stretch, ricampionamento con ciascun livello di qualità (con il
+throughput in frame al secondo), costruzione della piramide e disegno della
+forma d'onda.
+Controlla anche che il BPM rilevato coincida con quello della traccia e che
+l'Adjust a blocchi (streaming, su più blocchi) produca gli stessi campioni di
+quello in memoria.
+
+I risultati vanno in un file JSON; con --baseline si confrontano con quelli di
+una versione precedente e il comando termina con errore se una fase è più
+lenta o usa più memoria oltre la tolleranza, o se un BPM è sbagliato.
+
+Esempi:
+    python benchmark.py --output risultati.json
+    python benchmark.py --durations 10 60 --channels 2 --baseline risultati.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import soundfile as sf
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from audio_document import load_document
+from peak_stretch import adjust_file_streaming, adjust_waveform, marker_positions
+from resampler import QUALITIES
+from tempo import estimate_tempo
+from time_warp import TimeWarp, render_warp
+from waveform_pyramid import WaveformPyramid
+from waveform_view import BeatGrid, WaveformView
+
+FRAMERATE = 44100  # Frequenza delle tracce sintetiche
+DURATIONS = (10, 60, 600, 3600)  # Durate delle tracce in secondi (10 s, 1 min, 10 min, 1 h)
+BPMS = (97, 123, 140)  # BPM delle tracce, assegnati a rotazione (vedi track_bpm)
+KINDS = ('click', 'drums')  # Tipi di traccia sintetica
+STRETCH_ENGINE = 'wsola'  # Motore usato nella fase di time-stretch
+STREAM_BLOCK_FRAMES = 1 << 16  # Blocchi della fase streaming: anche le tracce brevi ne usano diversi
+RESAMPLE_RATIO = 0.97  # Rapporto sorgente/uscita della mappa usata per misurare i livelli di ricampionamento
+BPM_TOLERANCE = 1.0  # Errore massimo sul BPM rilevato
+TOLERANCE = 0.2  # Peggioramento relativo ammesso rispetto alla baseline
+MIN_SECONDS = 0.05  # Sotto questa differenza un rallentamento è considerato rumore di misura
+MIN_BYTES = 1 << 20  # Sotto questa differenza un aumento di memoria è ignorato
+FIGURE_SIZE = (10, 4)  # Pollici della figura usata per il disegno (1000 x 400 pixel)
+
+
+def decaying_tone(frequency, seconds, decay, framerate=FRAMERATE, end_frequency=None):
+    """Sinusoide con inviluppo esponenziale, con eventuale glissando (cassa)."""
+    t = np.arange(int(seconds * framerate)) / framerate
+    end_frequency = frequency if end_frequency is None else end_frequency
+    phase = 2 * np.pi * np.cumsum(np.geomspace(frequency, end_frequency, len(t))) / framerate
+    return (np.sin(phase) * np.exp(-t / decay)).astype(np.float32)
+
+
+def noise_burst(seconds, decay, rng, framerate=FRAMERATE, highpass=False):
+    """Rumore bianco con inviluppo esponenziale (rullante, charleston)."""
+    n = int(seconds * framerate)
+    noise = rng.standard_normal(n).astype(np.float32)
+    if highpass:
+        noise = np.diff(noise, prepend=0)  # Derivata: attenua le frequenze basse
+    return noise * np.exp(-np.arange(n) / (decay * framerate)).astype(np.float32)
+
+
+def place(track, sound, positions, gain=1.0):
+    """Somma sound nel track a ogni posizione (in frame), tagliandolo alla fine della traccia."""
+    for position in positions:
+        length = min(len(sound), len(track) - position)
+        track[position:position + length] += gain * sound[:length]
+
+
+def synthetic_track(kind, bpm, seconds, channels, seed=0):
+    """Genera una traccia (frames, canali) in int16 con il primo battito all'istante zero."""
+    rng = np.random.default_rng(seed)
+    n_frames = int(seconds * FRAMERATE)
+    beat = 60 / bpm
+    beats = np.round(np.arange(0, seconds, beat) * FRAMERATE).astype(int)
+    left = np.zeros(n_frames, dtype=np.float32)
+
+    if kind == 'click':
+        click = decaying_tone(1000, 0.02, 0.005)
+        place(left, click, beats[::4], 0.9)  # Accento sul primo battito della battuta
+        place(left, click, np.setdiff1d(beats, beats[::4]), 0.6)
+        right = left * 0.8 if channels == 2 else None
+    elif kind == 'drums':
+        kick = decaying_tone(120, 0.25, 0.06, end_frequency=45)
+        snare = noise_burst(0.15, 0.04, rng)
+        hihat = noise_burst(0.04, 0.008, rng, highpass=True)
+        eighths = np.round(np.arange(0, seconds, beat / 2) * FRAMERATE).astype(int)
+        place(left, kick, beats, 0.8)
+        place(left, snare, beats[1::2], 0.35)
+        right = left.copy() if channels == 2 else None
+        # Charleston spostato a destra nella versione stereo
+        place(left, hihat, eighths, 0.05 if channels == 2 else 0.1)
+        if right is not None:
+            place(right, hihat, eighths, 0.15)
+    else:
+        raise ValueError(f"Tipo di traccia sconosciuto: {kind}")
+
+    columns = [left] if right is None else [left, right]
+    track = np.empty((n_frames, len(columns)), dtype=np.int16)
+    for index, column in enumerate(columns):
+        track[:, index] = np.clip(column, -1, 1) * 32767
+    return track
+
+
+def track_bpm(kind, seconds, channels):
+    """BPM della traccia, sempre lo stesso per lo stesso caso (per confrontare esecuzioni diverse)."""
+    return BPMS[(KINDS.index(kind) + seconds + channels) % len(BPMS)]
+
+
+def measure(stages, name, function, memory=True):
+    """Esegue function misurandone il tempo e, in una seconda esecuzione, il picco di memoria allocata."""
+    start = time.perf_counter()
+    result = function()
+    stages[name] = {'seconds': time.perf_counter() - start}
+    if memory:
+        # Esecuzione separata: tracemalloc rallenta il codice Python e falserebbe i tempi
+        tracemalloc.start()
+        function()
+        stages[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def render_waveform(pyramid, bpm, phase):
+    """Disegna forma d'onda e griglia BPM a tutta durata e su una finestra di 5 secondi."""
+    figure = Figure(figsize=FIGURE_SIZE, dpi=100)
+    canvas = FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    WaveformView(ax, pyramid, color='orange')
+    BeatGrid(ax, 60 / bpm, pyramid.duration, offset=phase, color='red', linestyle='--')
+    canvas.draw()
+    ax.set_xlim(pyramid.duration / 2, pyramid.duration / 2 + 5)
+    canvas.draw()
+
+
+def run_case(directory, kind, bpm, seconds, channels, memory=True, stretch=True):
+    """Genera una traccia, esegue tutte le fasi e restituisce il risultato del caso."""
+    name = f"{kind}-{seconds}s-{'stereo' if channels == 2 else 'mono'}-{bpm}bpm"
+    path = os.path.join(directory, f"{name}.wav")
+    sf.write(path, synthetic_track(kind, bpm, seconds, channels), FRAMERATE, subtype='PCM_16')
+
+    stages = {}
+    document = measure(stages, 'load', lambda: load_document(path), memory)
+    detected_bpm, confidence, phase = measure(
+        stages, 'detect_bpm', lambda: estimate_tempo(document.samples, document.framerate), memory)
+    measure(stages, 'beat_positions',
+            lambda: marker_positions(document.n_frames, document.framerate, bpm, phase), memory)
+    adjusted = measure(stages, 'adjust', lambda: adjust_waveform(document.samples, document.framerate, bpm,
+                                                                 beat_phase=phase), memory)
+    streamed_path = os.path.join(directory, f"{name}_streaming.wav")
+    measure(stages, 'streaming', lambda: adjust_file_streaming(path, streamed_path, bpm, beat_phase=phase,
+                                                               block_frames=STREAM_BLOCK_FRAMES), memory)
+    streamed, _ = sf.read(streamed_path, dtype='int16', always_2d=True)
+    streaming_error = int(np.max(np.abs(streamed.astype(np.int32) - adjusted.astype(np.int32)), initial=0))
+    os.remove(streamed_path)
+    warp = TimeWarp((0, document.n_frames - 1), (0, (document.n_frames - 1) * RESAMPLE_RATIO), document.n_frames)
+    for quality in QUALITIES:
+        stage = f'resample_{quality}'
+        measure(stages, stage, lambda: render_warp(document.samples, warp, quality=quality), memory)
+        stages[stage]['frames_per_second'] = round(document.n_frames / stages[stage]['seconds'])
+    if stretch:
+        measure(stages, 'stretch', lambda: adjust_waveform(document.samples, document.framerate, bpm,
+                                                           beat_phase=phase, engine=STRETCH_ENGINE), memory)
+    pyramid = measure(stages, 'pyramid', lambda: WaveformPyramid(document.samples, document.framerate), memory)
+    measure(stages, 'render', lambda: render_waveform(pyramid, bpm, phase), memory)
+    del document, pyramid  # Chiude la mappatura del file prima di cancellarlo (necessario su Windows)
+    os.remove(path)
+
+    bpm_error = abs(detected_bpm - bpm)
+    return {
+        'name': name,
+        'kind': kind,
+        'seconds': seconds,
+        'channels': channels,
+        'bpm': bpm,
+        'detected_bpm': round(float(detected_bpm), 3),
+        'confidence': round(float(confidence), 3),
+        'bpm_error': round(float(bpm_error), 3),
+        'bpm_ok': bool(bpm_error <= BPM_TOLERANCE),
+        'streaming_error': streaming_error,  # Differenza massima (LSB) tra Adjust a blocchi e in memoria
+        'streaming_ok': streaming_error == 0,
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Restituisce le descrizioni delle fasi peggiorate rispetto alla baseline oltre la tolleranza."""
+    previous = {case['name']: case['stages'] for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        for stage, values in case['stages'].items():
+            old = previous.get(case['name'], {}).get(stage)
+            if old is None:
+                continue
+            seconds, old_seconds = values['seconds'], old['seconds']
+            if seconds > old_seconds * (1 + tolerance) and seconds - old_seconds > MIN_SECONDS:
+                regressions.append(f"{case['name']} {stage}: {old_seconds:.3f}s -> {seconds:.3f}s")
+            peak, old_peak = values.get('peak_bytes'), old.get('peak_bytes')
+            if peak is not None and old_peak is not None:
+                if peak > old_peak * (1 + tolerance) and peak - old_peak > MIN_BYTES:
+                    regressions.append(f"{case['name']} {stage}: {old_peak / 2**20:.1f} MB -> {peak / 2**20:.1f} MB")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark delle fasi DSP su tracce sintetiche a BPM noto.")
+    parser.add_argument("--durations", nargs="+", type=int, default=DURATIONS,
+                        help="Durate delle tracce in secondi (default: 10 60 600 3600)")
+    parser.add_argument("--channels", nargs="+", type=int, choices=(1, 2), default=(1, 2),
+                        help="Canali delle tracce (default: 1 2)")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=KINDS,
+                        help="Tipi di traccia (default: click drums)")
+    parser.add_argument("--output", default="benchmark.json", help="File JSON dei risultati")
+    parser.add_argument("--baseline", help="Risultati JSON di una versione precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Peggioramento relativo ammesso rispetto alla baseline (default: 0.2)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Misura solo i tempi (dimezza la durata del benchmark)")
+    parser.add_argument("--no-stretch", action="store_true",
+                        help="Salta la fase di time-stretch, la più lenta sulle tracce lunghe")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cases': [],
+    }
+
+    cases = [(kind, seconds, channels) for seconds in args.durations for kind in args.kinds
+             for channels in args.channels]
+    with tempfile.TemporaryDirectory() as directory:
+        for kind, seconds, channels in cases:
+            case = run_case(directory, kind, track_bpm(kind, seconds, channels), seconds, channels,
+                            not args.no_memory, not args.no_stretch)
+            results['cases'].append(case)
+            steps = ", ".join(f"{name} {values['seconds']:.3f}s" for name, values in case['stages'].items())
+            status = "ok" if case['bpm_ok'] else "ERRATO"
+            streaming = "" if case['streaming_ok'] else f", streaming diverso di {case['streaming_error']} LSB"
+            print(f"{case['name']}: rilevati {case['detected_bpm']:.2f} BPM ({status}{streaming}) [{steps}]")
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"Risultati scritti in {args.output}")
+
+    failures = [case['name'] for case in results['cases'] if not case['bpm_ok']]
+    for name in failures:
+        print(f"BPM errato: {name}")
+    mismatches = [case['name'] for case in results['cases'] if not case['streaming_ok']]
+    for name in mismatches:
+        print(f"Streaming diverso dall'Adjust in memoria: {name}")
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Peggioramento: {regression}")
+    return 1 if failures or mismatches or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
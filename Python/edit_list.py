@@ -0,0 +1,216 @@
+"""Lista di montaggio non distruttiva sopra una registrazione immutabile.
+
+Una EditList è una tupla di segmenti (inizio, fine) in frame della sorgente.
+Tagliare crea una nuova lista che condivide i segmenti non toccati, senza
+leggere né riscrivere l'audio. Anteprima (EditedAudio) e disegno
+(EditedPyramid) leggono la sorgente attraverso la lista con un costo che
+dipende dal numero di segmenti; l'audio montato viene scritto solo al
+salvataggio, un blocco alla volta (render_edits).
+
+A ogni giunzione tra segmenti non contigui anteprima e salvataggio applicano
+un crossfade equal-power di FADE_FRAMES frame centrato sul taglio: il segmento
+precedente prosegue oltre la sua fine sfumando, il successivo entra prima del
+suo inizio. I frame di tutte le giunzioni si calcolano insieme (seam_frames) e
+si sovrascrivono nei blocchi letti (apply_seams), senza cicli sui segmenti.
+"""
+import numpy as np
+import soundfile as sf
+
+BLOCK_FRAMES = 65536  # Frame letti e scritti per volta durante il salvataggio
+FADE_FRAMES = 256  # Frame del crossfade a ogni giunzione (circa 5 ms a 48 kHz)
+
+_windows = {}  # Lunghezza -> finestre (uscita, entrata) precalcolate
+
+
+class EditList:
+    """Sequenza immutabile di segmenti della sorgente che compongono il montaggio."""
+
+    def __init__(self, segments):
+        self.segments = tuple((int(start), int(stop)) for start, stop in segments if stop > start)
+
+    @classmethod
+    def whole(cls, n_frames):
+        """Montaggio iniziale: tutta la registrazione."""
+        return cls([(0, n_frames)])
+
+    @property
+    def n_frames(self):
+        return sum(stop - start for start, stop in self.segments)
+
+    def cut(self, start, stop):
+        """Restituisce un nuovo montaggio senza i frame [start, stop) del montaggio corrente."""
+        segments = []
+        offset = 0
+        for source_start, source_stop in self.segments:
+            length = source_stop - source_start
+            if start > offset:
+                segments.append((source_start, source_start + min(length, start - offset)))
+            if stop < offset + length:
+                segments.append((source_start + max(0, stop - offset), source_stop))
+            offset += length
+        return EditList(_merge(segments))
+
+    def seams(self, fade_frames=FADE_FRAMES):
+        """Giunzioni da sfumare come array (posizione nel montaggio, inizio uscente, inizio entrante).
+
+        Ogni crossfade copre i frame [posizione, posizione + fade_frames) del
+        montaggio; uscente ed entrante sono i primi frame della sorgente letti
+        dal segmento precedente e dal successivo. Si sfumano solo le giunzioni
+        tra segmenti lunghi almeno fade_frames, così i crossfade non si sovrappongono.
+        """
+        bounds = np.array(self.segments, dtype=np.int64).reshape(-1, 2)
+        lengths = bounds[:, 1] - bounds[:, 0]
+        joins = np.cumsum(lengths)[:-1]  # Inizio nel montaggio di ogni segmento dopo il primo
+        half = fade_frames // 2
+        usable = (lengths[:-1] >= fade_frames) & (lengths[1:] >= fade_frames)
+        return (joins[usable] - half, bounds[:-1, 1][usable] - half, bounds[1:, 0][usable] - half)
+
+    def source_ranges(self, start=0, stop=None):
+        """Per l'intervallo [start, stop) del montaggio restituisce (posizione nel montaggio, inizio, fine) nella sorgente."""
+        stop = self.n_frames if stop is None else stop
+        ranges = []
+        offset = 0
+        for source_start, source_stop in self.segments:
+            length = source_stop - source_start
+            first, last = max(start, offset), min(stop, offset + length)
+            if first < last:
+                ranges.append((first, source_start + first - offset, source_start + last - offset))
+            offset += length
+            if offset >= stop:
+                break
+        return ranges
+
+
+class EditedAudio:
+    """Vista dei campioni montati, letta a fette dalla sorgente (per esempio dal motore di riproduzione)."""
+
+    def __init__(self, samples, edits):
+        self.samples = samples  # Array (frames, canali) della registrazione sorgente
+        self.edits = edits
+        positions, outgoing, incoming = edits.seams()
+        self.seam_positions = positions
+        self.seam_frames = seam_frames(_frames(samples, outgoing), _frames(samples, incoming), samples.dtype)
+        self.shape = (edits.n_frames, samples.shape[1])
+        self.dtype = samples.dtype
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("EditedAudio supporta solo fette di frame")
+        start, stop, _ = index.indices(len(self))
+        parts = [self.samples[first:last] for _, first, last in self.edits.source_ranges(start, stop)]
+        if not parts:
+            return np.empty((0, self.shape[1]), dtype=self.dtype)
+        block = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        return apply_seams(block, start, self.seam_positions, self.seam_frames)
+
+
+class EditedPyramid:
+    """Adatta la piramide della sorgente al montaggio, per WaveformView."""
+
+    def __init__(self, pyramid, edits):
+        self.pyramid = pyramid
+        self.edits = edits
+        self.framerate = pyramid.framerate
+        self.n_frames = edits.n_frames
+
+    @property
+    def duration(self):
+        return self.n_frames / self.framerate
+
+    def limits(self):
+        return self.pyramid.limits()
+
+    def envelope(self, start, stop, width):
+        """Come WaveformPyramid.envelope, con le posizioni espresse nel tempo del montaggio."""
+        start = max(0, int(start))
+        stop = min(self.n_frames, int(np.ceil(stop)))
+        parts = []
+        for offset, first, last in self.edits.source_ranges(start, stop):
+            segment_width = max(1, width * (last - first) / (stop - start))
+            positions, mins, maxs, rms = self.pyramid.envelope(first, last, segment_width)
+            parts.append((np.maximum(positions - first, 0) + offset, mins, maxs, rms))
+        if not parts:
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+        return tuple(np.concatenate(values) for values in zip(*parts))
+
+
+def render_edits(source_path, edits, destination, block_frames=BLOCK_FRAMES):
+    """Scrive il montaggio in destination leggendo la sorgente a blocchi, con lo stesso formato."""
+    with sf.SoundFile(source_path) as source:
+        # Interi per i formati PCM (copia esatta dei campioni), float per quelli in virgola mobile
+        dtype = 'float64' if source.subtype in ('FLOAT', 'DOUBLE') else 'int32'
+        positions, outgoing, incoming = edits.seams()
+
+        def read_context(starts):
+            # Solo FADE_FRAMES frame per giunzione: la lettura resta un ciclo, il calcolo no
+            frames = np.zeros((len(starts), FADE_FRAMES, source.channels), dtype=dtype)
+            for row, start in enumerate(starts):
+                source.seek(max(0, start))
+                context = source.read(FADE_FRAMES - max(0, -start), dtype=dtype, always_2d=True)
+                frames[row, max(0, -start):max(0, -start) + len(context)] = context
+            return frames
+
+        joined = seam_frames(read_context(outgoing), read_context(incoming), dtype)
+        with sf.SoundFile(destination, mode='w', samplerate=source.samplerate, channels=source.channels,
+                          subtype=source.subtype) as output:
+            for position, first, last in edits.source_ranges():
+                source.seek(first)
+                for offset in range(first, last, block_frames):
+                    block = source.read(min(block_frames, last - offset), dtype=dtype, always_2d=True)
+                    output.write(apply_seams(block, position + offset - first, positions, joined))
+
+
+def crossfade_window(length):
+    """Finestre equal-power (uscita, entrata) di length frame, colonne float32: cos² + sin² = 1."""
+    if length not in _windows:
+        angle = (np.arange(length) + 0.5) / length * (np.pi / 2)
+        fade_out, fade_in = np.cos(angle).astype(np.float32), np.sin(angle).astype(np.float32)
+        fade_out.flags.writeable = fade_in.flags.writeable = False
+        _windows[length] = fade_out[:, np.newaxis], fade_in[:, np.newaxis]
+    return _windows[length]
+
+
+def seam_frames(outgoing, incoming, dtype):
+    """Crossfade di tutte le giunzioni in un'unica operazione: (giunzioni, frame, canali) -> stessa forma in dtype."""
+    fade_out, fade_in = crossfade_window(outgoing.shape[1])
+    mixed = outgoing * fade_out + incoming * fade_in  # Broadcast sulle giunzioni: float32 con ingressi interi
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        limits = np.iinfo(dtype)
+        mixed = np.clip(np.rint(mixed), limits.min, limits.max)  # Equal-power: segnali correlati salgono fino a √2
+    return mixed.astype(dtype)
+
+
+def apply_seams(block, block_start, positions, frames):
+    """Sovrascrive nel blocco (che inizia al frame block_start del montaggio) i frame delle giunzioni che tocca."""
+    fade_frames = frames.shape[1]
+    touching = np.flatnonzero((positions < block_start + len(block)) & (positions + fade_frames > block_start))
+    if len(touching) == 0:
+        return block
+    rows = positions[touching, np.newaxis] + np.arange(fade_frames) - block_start
+    inside = (rows >= 0) & (rows < len(block))
+    block = block.copy()  # Può essere una vista della registrazione, che non va modificata
+    block[rows[inside]] = frames[touching][inside]
+    return block
+
+
+def _frames(samples, starts, fade_frames=FADE_FRAMES):
+    """Frame [start, start + fade_frames) della sorgente per ogni start, come (len(starts), fade_frames, canali)."""
+    index = np.clip(starts[:, np.newaxis] + np.arange(fade_frames), 0, len(samples) - 1)
+    return np.take(samples, index, axis=0)
+
+
+def _merge(segments):
+    """Unisce i segmenti contigui nella sorgente."""
+    merged = []
+    for start, stop in segments:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
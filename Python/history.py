@@ -0,0 +1,65 @@
+"""Cronologia annulla/ripeti condivisa dalle tre applicazioni.
+
+La cronologia conserva stati immutabili e piccoli: liste di montaggio che
+condividono i segmenti (WaveRecorder), tuple di BPM e marker (AudioStretcher)
+o i parametri di un Adjust (PeakStretcher), mai copie dei campioni. Anche
+una cronologia profonda su registrazioni lunghe occupa pochi kilobyte; l'audio
+di uno stato si ricostruisce dalla sorgente quando lo si ripristina.
+"""
+
+UNDO_LIMIT = 200  # Stati conservati al massimo (i più vecchi vengono scartati)
+
+
+class History:
+    """Pila di stati con annulla/ripeti; lo stato corrente è sempre l'ultimo della pila."""
+
+    def __init__(self, limit=UNDO_LIMIT):
+        self.limit = limit
+        self.states = []
+        self.redo_states = []
+
+    @property
+    def current(self):
+        return self.states[-1] if self.states else None
+
+    def reset(self, state):
+        """Ricomincia la cronologia da state (per esempio dopo aver caricato un file)."""
+        self.states = [state]
+        self.redo_states = []
+
+    def push(self, state):
+        """Registra un nuovo stato; uno stato uguale al corrente non crea una voce."""
+        if self.states and state == self.current:
+            return
+        self.states.append(state)
+        del self.states[:-self.limit]
+        self.redo_states = []
+
+    def snapshot(self):
+        """Stati da annullare e da ripetere come liste, per salvarli in una sessione."""
+        return {'states': list(self.states), 'redo': list(self.redo_states)}
+
+    def restore(self, snapshot):
+        """Ripristina una cronologia salvata con snapshot(); lo stato corrente è l'ultimo di 'states'."""
+        self.states = list(snapshot['states'])[-self.limit:]
+        self.redo_states = list(snapshot['redo'])
+
+    def can_undo(self):
+        return len(self.states) > 1
+
+    def can_redo(self):
+        return bool(self.redo_states)
+
+    def undo(self):
+        """Torna allo stato precedente e lo restituisce (None se non c'è)."""
+        if not self.can_undo():
+            return None
+        self.redo_states.append(self.states.pop())
+        return self.current
+
+    def redo(self):
+        """Ripristina l'ultimo stato annullato e lo restituisce (None se non c'è)."""
+        if not self.can_redo():
+            return None
+        self.states.append(self.redo_states.pop())
+        return self.current
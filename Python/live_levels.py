@@ -0,0 +1,81 @@
+"""Storico dei livelli di ingresso per la vista dal vivo durante la registrazione.
+
+La callback audio riduce ogni blocco a minimo, massimo e somma dei quadrati
+per bucket di durata fissa e li scrive in un buffer circolare di dimensione
+costante. Il thread di Tk legge solo il buffer circolare, quindi il costo del
+disegno non dipende né dalla durata della registrazione né dalla dimensione
+dei blocchi della scheda audio.
+"""
+import numpy as np
+
+BUCKET_SECONDS = 0.01  # Durata di una colonna della vista dal vivo
+HISTORY_SECONDS = 10  # Secondi visibili nella vista dal vivo
+PEAK_HOLD_SECONDS = 1.5  # Finestra su cui si mantiene l'indicatore di picco
+CLIP_LEVEL = 0.999  # Ampiezza (in float, fondo scala 1.0) considerata clipping
+
+
+class LevelHistory:
+    """Buffer circolare di min/max/RMS per bucket, scritto dalla callback e letto dalla vista."""
+
+    def __init__(self, framerate, seconds=HISTORY_SECONDS, bucket_seconds=BUCKET_SECONDS):
+        self.framerate = framerate
+        self.bucket_frames = max(1, int(round(bucket_seconds * framerate)))
+        self.bucket_seconds = self.bucket_frames / framerate
+        self.capacity = int(np.ceil(seconds / self.bucket_seconds))
+        self.mins = np.zeros(self.capacity, dtype=np.float32)
+        self.maxs = np.zeros(self.capacity, dtype=np.float32)
+        self.squares = np.zeros(self.capacity, dtype=np.float32)  # Media dei quadrati per bucket
+        self.count = 0  # Bucket completati dall'inizio della registrazione
+        self.clipped = False  # Resta True dopo il primo campione oltre CLIP_LEVEL
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self.pending_frames = 0
+        self.pending_min = np.inf
+        self.pending_max = -np.inf
+        self.pending_squares = 0.0
+
+    def add(self, block):
+        """Da chiamare nella callback audio con il blocco (frames, canali) ricevuto."""
+        block = np.asarray(block)
+        if block.ndim == 2:
+            lows, highs = block.min(axis=1), block.max(axis=1)
+            squares = np.einsum('ij,ij->i', block, block) / block.shape[1]
+        else:
+            lows = highs = block
+            squares = block * block
+        if len(block) and max(-lows.min(), highs.max()) >= CLIP_LEVEL:
+            self.clipped = True
+
+        start = 0
+        while start < len(block):
+            # Completa il bucket in corso con al più i frame che mancano
+            stop = min(len(block), start + self.bucket_frames - self.pending_frames)
+            self.pending_min = min(self.pending_min, lows[start:stop].min())
+            self.pending_max = max(self.pending_max, highs[start:stop].max())
+            self.pending_squares += float(squares[start:stop].sum())
+            self.pending_frames += stop - start
+            start = stop
+            if self.pending_frames == self.bucket_frames:
+                index = self.count % self.capacity
+                self.mins[index] = self.pending_min
+                self.maxs[index] = self.pending_max
+                self.squares[index] = self.pending_squares / self.bucket_frames
+                self.count += 1
+                self._reset_pending()
+
+    def snapshot(self):
+        """Restituisce (mins, maxs, rms) in ordine cronologico, con il bucket più recente in fondo."""
+        count = self.count  # Letto una volta: la callback può aggiungere bucket nel frattempo
+        index = count % self.capacity
+        order = np.roll(np.arange(self.capacity), -index)
+        # Prima di riempire il buffer le colonne più vecchie restano a zero (silenzio)
+        return self.mins[order], self.maxs[order], np.sqrt(self.squares[order])
+
+    def peak(self, seconds=PEAK_HOLD_SECONDS):
+        """Ampiezza massima negli ultimi secondi (indicatore di picco con tenuta)."""
+        n = min(self.count, self.capacity, max(1, int(seconds / self.bucket_seconds)))
+        if n == 0:
+            return 0.0
+        indices = (self.count - 1 - np.arange(n)) % self.capacity
+        return float(max(-self.mins[indices].min(), self.maxs[indices].max()))
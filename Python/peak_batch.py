@@ -0,0 +1,199 @@
+"""Elaborazione a lotti di PeakStretcher da riga di comando, senza interfaccia grafica.
+
+Per ogni file audio (WAV, FLAC, MP3) esegue rilevamento BPM -> Adjust -> scrittura
+del risultato in WAV a 16 bit, distribuendo i file su più processi.
+
+Esempi:
+    python peak_batch.py campioni/ --output-dir rigrigliati/
+    python peak_batch.py "stems/*.wav" --bpm 124 --range -8000 8000 --workers 4
+    python peak_batch.py live_set.wav --streaming --normalize running
+    python peak_batch.py voce.wav --engine wsola
+    python peak_batch.py ../Sounds/ --output-dir rigrigliati/
+    python peak_batch.py campioni/ --trace tempi.json
+    python peak_batch.py campioni/ --quality draft
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from audio_document import AUDIO_EXTENSIONS, load_document
+from peak_stretch import adjust_file_streaming, adjust_waveform
+from profiling import enable, enabled, export_trace, span, take_events, trace_events
+from resampler import QUALITIES
+from tempo import estimate_tempo
+
+OUTPUT_SUFFIX = "_adjusted"  # Suffisso dei file scritti
+DEFAULT_QUALITY = 'high'  # I file scritti sono il risultato finale: ricampionamento di qualità massima
+
+
+def collect_files(inputs):
+    """Espande cartelle e pattern glob nella lista ordinata dei file audio da elaborare.
+
+    Cartelle e pattern escludono i file già rielaborati (nome che termina con
+    OUTPUT_SUFFIX), scritti accanto alle sorgenti da un'esecuzione precedente;
+    un file indicato per nome viene elaborato comunque.
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for extension in AUDIO_EXTENSIONS:
+                files.extend(_sources(glob.glob(os.path.join(item, f"*{extension}"))))
+        elif glob.has_magic(item):
+            files.extend(_sources(glob.glob(item)))
+        else:
+            files.append(item)
+    return sorted(set(files))
+
+
+def _sources(paths):
+    """Scarta dai percorsi i risultati di PeakStretcher (stem che termina con OUTPUT_SUFFIX)."""
+    return [path for path in paths if not os.path.splitext(os.path.basename(path))[0].endswith(OUTPUT_SUFFIX)]
+
+
+def output_path(path, output_dir=None):
+    """Percorso del file rielaborato: stesso nome con suffisso ed estensione .wav, nella cartella scelta."""
+    stem, _ = os.path.splitext(os.path.basename(path))
+    directory = output_dir if output_dir else os.path.dirname(path)
+    return os.path.join(directory, f"{stem}{OUTPUT_SUFFIX}.wav")
+
+
+def write_wav(path, samples, framerate, n_channels):
+    """Scrive campioni int16 (frames, canali) in un file WAV."""
+    with wave.open(path, 'w') as wav_file:
+        wav_file.setnchannels(n_channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(framerate)
+        wav_file.writeframes(samples.tobytes())
+
+
+def process_file_streaming(path, destination, bpm=None, amplitude_range=None, normalization='two-pass',
+                           quality=DEFAULT_QUALITY):
+    """Elabora un file a blocchi, con memoria limitata indipendentemente dalla durata."""
+    start = time.perf_counter()
+    used_bpm, _ = adjust_file_streaming(path, destination, bpm, amplitude_range, normalization=normalization,
+                                        quality=quality)
+    return {
+        'path': path,
+        'output': destination,
+        'bpm': used_bpm,
+        'confidence': None,
+        'timings': {'streaming': time.perf_counter() - start},
+        'trace': collect_trace(),
+    }
+
+
+def process_file(path, destination, bpm=None, amplitude_range=None, engine=None, quality=DEFAULT_QUALITY):
+    """Elabora un file e restituisce un dizionario con BPM usato e tempi delle fasi."""
+    timings = {}
+    start = time.perf_counter()
+    document = load_document(path)
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    detected_bpm, confidence, beat_phase = estimate_tempo(document.samples, document.framerate)
+    timings['detect'] = time.perf_counter() - start
+    used_bpm = bpm if bpm else int(round(detected_bpm))
+
+    start = time.perf_counter()
+    adjusted = adjust_waveform(document.samples, document.framerate, used_bpm, amplitude_range, beat_phase,
+                               engine, quality=quality)
+    timings['adjust'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with span('write'):
+        write_wav(destination, adjusted, document.framerate, document.n_channels)
+    timings['write'] = time.perf_counter() - start
+
+    return {
+        'path': path,
+        'output': destination,
+        'bpm': used_bpm,
+        'confidence': confidence,
+        'timings': timings,
+        'trace': collect_trace(),
+    }
+
+
+def collect_trace():
+    """Span registrati dal processo di lavoro per il file appena elaborato, come eventi Trace Event."""
+    return trace_events(take_events()) if enabled() else []
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Allinea alla griglia BPM tutti i file audio indicati.")
+    parser.add_argument("inputs", nargs="+", help="File, cartelle o pattern glob di file audio (WAV, FLAC, MP3)")
+    parser.add_argument("--output-dir", help="Cartella di destinazione (default: accanto all'originale)")
+    parser.add_argument("--bpm", type=int, help="BPM da usare per tutti i file (default: rilevato)")
+    parser.add_argument("--range", nargs=2, type=float, metavar=("YMIN", "YMAX"),
+                        help="Fascia di ampiezza dei picchi da ignorare, in valori int16 per i file a 16 bit "
+                             "e tra -1 e 1 per gli altri (default: nessuna)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Numero di processi paralleli (default: numero di core)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Legge e scrive a blocchi, per file più grandi della memoria")
+    parser.add_argument("--normalize", choices=("two-pass", "running"), default="two-pass",
+                        help="Normalizzazione in modalità streaming (default: two-pass)")
+    parser.add_argument("--engine", choices=("resample", "wsola", "phase-vocoder"), default="resample",
+                        help="Motore di Adjust; wsola e phase-vocoder preservano l'intonazione (default: resample)")
+    parser.add_argument("--quality", choices=QUALITIES, default=DEFAULT_QUALITY,
+                        help="Qualità del ricampionamento del motore resample (default: high)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Esporta i tempi di ogni fase in formato Trace Event (chrome://tracing, Perfetto)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = collect_files(args.inputs)
+    if not files:
+        print("Nessun file audio trovato.")
+        return 1
+    if args.streaming and args.engine != "resample":
+        print("Il motore di time-stretch non è disponibile in modalità streaming.")
+        return 1
+    engine = None if args.engine == "resample" else args.engine
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    failures = 0
+    trace = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=enable if args.trace else None) as executor:
+        futures = {}
+        for path in files:
+            destination = output_path(path, args.output_dir)
+            if args.streaming:
+                future = executor.submit(process_file_streaming, path, destination, args.bpm, args.range,
+                                         args.normalize, args.quality)
+            else:
+                future = executor.submit(process_file, path, destination, args.bpm, args.range, engine,
+                                         args.quality)
+            futures[future] = path
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{path}: errore - {e}")
+                continue
+            trace.extend(result['trace'])
+            timings = result['timings']
+            steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+            confidence = "" if result['confidence'] is None else f" (affidabilità {result['confidence']:.0%})"
+            print(f"{path}: {result['bpm']} BPM{confidence} "
+                  f"-> {result['output']} [{steps}, totale {sum(timings.values()):.2f}s]")
+
+    print(f"{len(files) - failures}/{len(files)} file elaborati in {time.perf_counter() - start:.2f}s")
+    if args.trace:
+        export_trace(args.trace, trace)
+        print(f"Trace dei tempi salvato in {args.trace}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
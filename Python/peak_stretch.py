@@ -0,0 +1,404 @@
+"""Pipeline di PeakStretcher senza interfaccia grafica.
+
+adjust_waveform() allinea i picchi del segnale alla griglia BPM ed è usata sia
+dal pulsante Adjust di PeakStretcher sia dall'elaborazione a lotti di
+peak_batch.py. adjust_file_streaming() fa lo stesso leggendo e scrivendo a
+blocchi, per registrazioni più grandi della memoria.
+
+I segnali sono array (frames, canali). I picchi si cercano una sola volta sul
+massimo tra i canali (peak_summary) e la stessa mappa temporale si applica a
+tutti i canali insieme, così un file stereo costa quasi quanto uno mono.
+PeakIndex conserva i picchi di un file: cambiare BPM o fascia di ampiezza
+filtra l'indice invece di ripetere la ricerca sull'intero segnale. Le coppie
+picco -> marker formano un'unica mappa temporale monotona (time_warp.py),
+resa senza giunture tra i segmenti.
+"""
+import wave
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+
+from audio_document import read_blocks, read_info
+from profiling import span, timed
+from tempo import estimate_tempo_blocks
+from time_stretch import stretch_map
+from resampler import DEFAULT_QUALITY, get_resampler
+from time_warp import TimeWarp, render_warp
+
+FADE_OUT_SECONDS = 0.05  # Fade-out applicato alla fine del segnale rielaborato
+BLOCK_FRAMES = 1 << 20  # Frame per gruppo di segmenti e per blocco di lettura e di rendering
+HEIGHT_RATIO = 0.5  # Altezza minima dei picchi, in frazione del massimo del segnale
+PROMINENCE_SECONDS = 2.0  # Finestra in cui si cercano le basi dei picchi per prominenze e larghezze
+
+
+def marker_positions(n_frames, framerate, bpm, beat_phase=0.0):
+    """Posizioni in frame dei marker BPM, a partire dal primo battito."""
+    interval = 60 / bpm  # Intervallo tra i marker in secondi
+    duration = n_frames / framerate
+    return np.array(np.arange(beat_phase, duration, interval) * framerate, dtype=int)
+
+
+def segment_markers(n_frames, framerate, bpm, beat_phase=0.0):
+    """Marker BPM usati per i segmenti; se il primo battito è oltre la fine, un solo segmento."""
+    markers = marker_positions(n_frames, framerate, bpm, beat_phase)
+    if len(markers) == 0:
+        markers = np.zeros(1, dtype=int)
+    return markers
+
+
+def segment_bounds(markers, n_frames):
+    """Inizio e fine (esclusa) dei segmenti: dal marker corrente al successivo, il primo parte da 0."""
+    starts = np.concatenate(([0], markers[1:]))
+    ends = np.append(markers[1:], n_frames)
+    return starts, ends
+
+
+def closest_peaks(peaks, markers, ends):
+    """Per ogni segmento il picco più vicino al suo marker, -1 se il segmento non ha picchi."""
+    segments = np.searchsorted(ends, peaks, side='right')  # Segmento di ogni picco
+    distance = np.abs(peaks - markers[segments])
+    order = np.lexsort((distance, segments))  # Per segmento, dal picco più vicino (a parità, il primo)
+    found, first = np.unique(segments[order], return_index=True)
+    closest = np.full(len(markers), -1, dtype=np.int64)
+    closest[found] = peaks[order[first]]
+    return closest
+
+
+def anchor_points(markers, ends, peaks, relevant, n_frames):
+    """Coppie marker -> picco più vicino, estese agli estremi del file: i punti della mappa temporale."""
+    closest = closest_peaks(peaks[relevant], markers, ends)
+    found = closest >= 0
+    targets = np.concatenate(([0], markers[found], [n_frames]))
+    sources = np.concatenate(([0], closest[found], [n_frames]))
+    if targets[1] == 0:  # Un marker sull'istante zero sostituisce il punto (0, 0)
+        targets, sources = targets[1:], sources[1:]
+    return targets, sources
+
+
+def peak_summary(samples):
+    """Segnale 1D su cui cercare i picchi: il massimo tra i canali di ogni frame (una vista per i file mono)."""
+    summary = samples[:, 0]
+    for channel in range(1, samples.shape[1]):
+        # Un canale alla volta: molto più veloce di max(axis=1) su pochi canali
+        summary = np.maximum(summary, samples[:, channel])
+    return summary
+
+
+@timed('peak detection')
+def detect_peaks(summary, framerate, bpm, height, amplitude_range=None):
+    """Picchi di peak_summary() e maschera dei picchi rilevanti (fuori dalla fascia di ampiezza)."""
+    interval = 60 / bpm
+    peaks, _ = find_peaks(summary, height=height, distance=framerate * interval / 2)
+    if amplitude_range is None:
+        relevant = np.ones(len(peaks), dtype=bool)
+    else:
+        ymin, ymax = amplitude_range
+        relevant = (summary[peaks] < ymin) | (summary[peaks] > ymax)
+    return peaks, relevant
+
+
+class PeakIndex:
+    """Picchi di un file calcolati una volta: posizioni ordinate, altezze, prominenze e larghezze.
+
+    L'indice contiene i massimi locali di peak_summary() alti almeno
+    height_ratio volte il massimo. Soglia e fascia di ampiezza diventano
+    maschere sulle altezze; la distanza minima (che dipende dal BPM) si applica
+    come in find_peaks (a parità di altezza vince il picco più a sinistra),
+    solo sui picchi dell'indice, e la selezione viene
+    memorizzata per (altezza, distanza).
+    """
+
+    @timed('peak index')
+    def __init__(self, samples, framerate, height_ratio=HEIGHT_RATIO):
+        samples = samples[:, np.newaxis] if samples.ndim == 1 else samples
+        self.framerate = framerate
+        self._samples = samples
+        self._summary = peak_summary(samples)
+        self.min_height = float(np.max(self._summary)) * height_ratio
+        self.positions, properties = find_peaks(self._summary, height=self.min_height)
+        self.heights = properties['peak_heights']
+        self._prominences = None
+        self._widths = None
+        self._spaced = {}  # (altezza, distanza) -> indici dei picchi selezionati
+
+    @classmethod
+    def restore(cls, samples, framerate, min_height, positions, heights):
+        """Indice già calcolato (per esempio letto da una sessione); il riassunto si ricalcola solo se serve."""
+        index = cls.__new__(cls)
+        index.framerate = framerate
+        index._samples = samples[:, np.newaxis] if samples.ndim == 1 else samples
+        index._summary = None
+        index.min_height = float(min_height)
+        index.positions = np.asarray(positions)
+        index.heights = np.asarray(heights)
+        index._prominences = None
+        index._widths = None
+        index._spaced = {}
+        return index
+
+    @property
+    def summary(self):
+        """Massimo per frame tra i canali (peak_summary), su cui sono stati cercati i picchi."""
+        if self._summary is None:
+            self._summary = peak_summary(self._samples)
+        return self._summary
+
+    @property
+    def prominences(self):
+        if self._prominences is None:
+            window = int(PROMINENCE_SECONDS * self.framerate) | 1  # wlen deve essere dispari
+            self._prominences = peak_prominences(self.summary, self.positions, wlen=window)
+        return self._prominences[0]
+
+    @property
+    def widths(self):
+        """Larghezze in frame a metà prominenza."""
+        if self._widths is None:
+            self.prominences  # Le larghezze riusano i dati delle prominenze
+            self._widths = peak_widths(self.summary, self.positions, prominence_data=self._prominences)[0]
+        return self._widths
+
+    def spaced(self, height, distance):
+        """Indici dei picchi alti almeno height e distanti almeno distance frame (come find_peaks, parità al più a sinistra)."""
+        key = (height, distance)
+        if key not in self._spaced:
+            if height < self.min_height:
+                raise ValueError(f"Soglia {height} sotto quella dell'indice ({self.min_height})")
+            candidates = np.flatnonzero(self.heights >= height)
+            kept = _select_by_distance(self.positions[candidates], self.heights[candidates], distance)
+            self._spaced[key] = candidates[kept]
+        return self._spaced[key]
+
+    @timed('peak selection')
+    def select(self, bpm, amplitude_range=None, height=None):
+        """Come detect_peaks sull'intero segnale: restituisce i picchi e la maschera dei rilevanti."""
+        height = self.min_height if height is None else height
+        chosen = self.spaced(height, self.framerate * 60 / bpm / 2)
+        peaks = self.positions[chosen]
+        if amplitude_range is None:
+            return peaks, np.ones(len(peaks), dtype=bool)
+        ymin, ymax = amplitude_range
+        heights = self.heights[chosen]
+        return peaks, (heights < ymin) | (heights > ymax)
+
+
+def _select_by_distance(positions, heights, distance):
+    """Maschera dei picchi tenuti dal vincolo di distanza di find_peaks: prima i più alti.
+
+    A parità di altezza (per esempio sui plateau a 32767 dei segnali saturati)
+    vince il picco più a sinistra, così il risultato non dipende da come i
+    candidati sono stati raccolti (in memoria o a blocchi).
+    """
+    distance = np.ceil(distance)
+    keep = np.ones(len(positions), dtype=bool)
+    # Vicini troppo prossimi di ogni picco: [low, high) escluso il picco stesso
+    lows = np.searchsorted(positions, positions - distance, side='right')
+    highs = np.searchsorted(positions, positions + distance, side='left')
+    order = np.lexsort((positions, -np.asarray(heights, dtype=np.float64)))  # Altezza decrescente, poi posizione
+    for index in order:
+        if keep[index]:
+            keep[lows[index]:index] = False
+            keep[index + 1:highs[index]] = False
+    return keep
+
+
+@timed('adjust')
+def adjust_waveform(waveform, framerate, bpm, amplitude_range=None, beat_phase=0.0, engine=None, progress=None,
+                    peak_index=None, warp_cache=None, quality=DEFAULT_QUALITY):
+    """Sposta i picchi rilevanti sui marker BPM e restituisce il segnale rielaborato in int16.
+
+    waveform è un array (frames, canali), o 1D per un segnale mono; il
+    risultato ha la stessa forma. amplitude_range è la coppia (ymin, ymax) scelta nel grafico: sono rilevanti i
+    picchi fuori da questa fascia. Con None tutti i picchi sono rilevanti.
+    engine None ricampiona il segnale seguendo un'unica mappa temporale
+    (TimeWarp) che porta ogni picco rilevante sul suo marker; 'wsola' o
+    'phase-vocoder' seguono la stessa mappa senza cambiare l'intonazione.
+    progress, se indicata, riceve la frazione completata (0-1) tra un blocco e
+    l'altro e può sollevare un'eccezione per interrompere il lavoro.
+    peak_index è il PeakIndex dello stesso segnale, da riusare tra un Adjust e
+    l'altro; senza, viene calcolato per questa chiamata. warp_cache è un
+    dizionario conservato tra le chiamate sullo stesso segnale: con engine None
+    vi resta l'ultimo rendering, e al successivo si ricalcola solo l'intervallo
+    in cui la mappa è cambiata. quality sceglie l'interpolatore del
+    ricampionamento: 'draft' per le prove interattive, 'normal' o 'high' per il
+    risultato finale (vedi resampler.py).
+    """
+    progress = progress or _ignore_progress
+    samples = waveform[:, np.newaxis] if waveform.ndim == 1 else waveform
+    n_frames = len(samples)
+    markers = segment_markers(n_frames, framerate, bpm, beat_phase)
+    peak_index = peak_index or PeakIndex(samples, framerate)
+    peaks, relevant = peak_index.select(bpm, amplitude_range)
+    _, ends = segment_bounds(markers, n_frames)
+    targets, sources = anchor_points(markers, ends, peaks, relevant, n_frames)
+    progress(0.1)  # Rilevamento dei picchi completato
+
+    def render_progress(fraction):
+        progress(0.1 + 0.85 * fraction)
+
+    if engine is not None:
+        with span('stretch', engine=engine):
+            adjusted_audio = stretch_map(samples, targets, sources, n_frames, engine, render_progress)
+    else:
+        warp = TimeWarp(targets, sources, n_frames)
+        previous = warp_cache.get(('resample', quality)) if warp_cache is not None else None
+        with span('resample', quality=quality):
+            adjusted_audio = render_warp(samples, warp, previous, render_progress, quality=quality)
+        if warp_cache is not None:
+            warp_cache[('resample', quality)] = (warp, adjusted_audio)  # Una sola assegnazione: sicura tra thread
+
+    with span('normalization'):
+        # Applica normalizzazione (in un nuovo array: il rendering può restare nella cache)
+        adjusted_audio = adjusted_audio * normalization_gain(max(adjusted_audio.max(), -adjusted_audio.min()))
+
+        # Applica un fade-out alla fine del segnale
+        fade_out_length = int(FADE_OUT_SECONDS * framerate)
+        fade_out = np.linspace(1, 0, fade_out_length)
+        adjusted_audio[-fade_out_length:] *= fade_out[:, np.newaxis]
+
+        # Converti a int16
+        adjusted_audio = adjusted_audio.astype(np.int16)
+    return adjusted_audio[:, 0] if waveform.ndim == 1 else adjusted_audio
+
+
+def _ignore_progress(fraction):
+    pass
+
+
+def normalization_gain(peak):
+    """Guadagno che porta peak al fondo scala int16; 1 per un segnale silenzioso (niente divisione per zero)."""
+    return 32767 / peak if peak > 0 else 1.0
+
+
+def streamed_peaks(blocks, n_frames, framerate, bpm, height, amplitude_range=None, beat_phase=0.0):
+    """Versione a blocchi della ricerca dei picchi: restituisce (picchi, rilevanti) dell'intero file.
+
+    blocks è un iterabile di array (frames, canali) consecutivi; i segmenti vengono esaminati
+    appena sono completi, con una sovrapposizione di mezzo battito per la
+    ricerca dei picchi, così in memoria resta solo qualche blocco. Dai blocchi
+    si raccolgono solo i candidati (massimi locali alti almeno height); la
+    distanza minima si applica alla fine su tutti i candidati insieme, con la
+    stessa selezione di PeakIndex, quindi il risultato coincide con quello in memoria.
+    """
+    markers = segment_markers(n_frames, framerate, bpm, beat_phase)
+    starts, ends = segment_bounds(markers, n_frames)
+    found_peaks, found_heights = [], []
+    margin = int(np.ceil(framerate * 60 / bpm / 2))  # Distanza minima tra i picchi
+
+    buffer = np.zeros((0, 1))  # Sostituito dal primo blocco
+    buffer_start = 0  # Frame assoluto di buffer[0]
+    next_segment = 0
+    blocks = iter(blocks)
+    while next_segment < len(ends):
+        block = next(blocks, None)
+        if block is not None:
+            buffer = np.concatenate((buffer, block)) if len(buffer) else block
+        available = buffer_start + len(buffer)
+        at_end = block is None or available >= n_frames
+
+        # Segmenti completi, con il margine successivo già letto (o a fine file)
+        limit = n_frames if at_end else available - margin
+        last = int(np.searchsorted(ends, limit, side='right'))
+        if last <= next_segment:
+            if at_end:
+                raise ValueError("Il file è più corto di quanto dichiarato nell'intestazione")
+            continue
+
+        first = next_segment
+        context_start = max(buffer_start, starts[first] - margin)
+        context_end = min(available, ends[last - 1] + margin)
+        context = buffer[context_start - buffer_start:context_end - buffer_start]
+        peaks, properties = find_peaks(peak_summary(context), height=height)
+        peaks += context_start
+        inside = (peaks >= starts[first]) & (peaks < ends[last - 1])
+        found_peaks.append(peaks[inside])
+        found_heights.append(properties['peak_heights'][inside])
+        next_segment = last
+
+        # Scarta i frame già elaborati, tenendo il margine per i picchi del gruppo successivo
+        keep_from = max(buffer_start, ends[last - 1] - margin)
+        buffer = buffer[keep_from - buffer_start:]
+        buffer_start = keep_from
+
+    candidates, heights = np.concatenate(found_peaks), np.concatenate(found_heights)
+    kept = _select_by_distance(candidates, heights, framerate * 60 / bpm / 2)
+    peaks, heights = candidates[kept], heights[kept]
+    if amplitude_range is None:
+        return peaks, np.ones(len(peaks), dtype=bool)
+    ymin, ymax = amplitude_range
+    return peaks, (heights < ymin) | (heights > ymax)
+
+
+def warped_blocks(path, warp, block_frames=BLOCK_FRAMES, quality=DEFAULT_QUALITY):
+    """Rende la mappa temporale a blocchi leggendo dal file solo i frame della sorgente necessari."""
+    dtype = read_info(path).dtype
+    half_taps = get_resampler(quality).half_taps
+    with sf.SoundFile(path) as audio_file:
+        for start in range(0, warp.n_frames, block_frames):
+            stop = min(warp.n_frames, start + block_frames)
+            first, last = warp.source_range(start, stop, half_taps)
+            audio_file.seek(first)
+            source = audio_file.read(last - first, dtype=dtype, always_2d=True)
+            yield warp.render(source, start, stop, offset=first, quality=quality)
+
+
+def write_normalized(writer, blocks, gain, framerate, n_channels=1):
+    """Scrive blocchi float (frames, canali) con guadagno (fisso o funzione del blocco) e fade-out finale."""
+    fade_out_length = int(FADE_OUT_SECONDS * framerate)
+    tail = np.zeros((0, n_channels), dtype=np.float32)  # Ultimi frame trattenuti finché non si sa dove finisce il file
+    for block in blocks:
+        block_gain = gain(block) if callable(gain) else gain
+        pending = np.concatenate((tail, block * block_gain))
+        split = max(0, len(pending) - fade_out_length)
+        writer.writeframes(pending[:split].astype(np.int16).tobytes())
+        tail = pending[split:]
+    tail[-fade_out_length:] *= np.linspace(1, 0, fade_out_length)[-len(tail):, np.newaxis]
+    writer.writeframes(tail.astype(np.int16).tobytes())
+
+
+def adjust_file_streaming(source, destination, bpm=None, amplitude_range=None, beat_phase=None,
+                          normalization='two-pass', block_frames=BLOCK_FRAMES, quality=DEFAULT_QUALITY):
+    """Rielabora un file audio a blocchi scrivendo il risultato (WAV a 16 bit) man mano, con memoria limitata.
+
+    Senza bpm il tempo viene stimato con una lettura preliminare a blocchi.
+    normalization è 'two-pass' (un primo passaggio trova il picco del risultato,
+    il secondo scrive) oppure 'running' (un solo passaggio, guadagno calcolato sul
+    picco massimo visto fino al blocco corrente). quality è il livello del
+    ricampionamento, come in adjust_waveform(). Restituisce (bpm, fase).
+    """
+    info = read_info(source)
+    if bpm is None or beat_phase is None:
+        detected_bpm, _, detected_phase = estimate_tempo_blocks(read_blocks(source, block_frames), info.framerate)
+        bpm = bpm if bpm is not None else int(round(detected_bpm))
+        beat_phase = beat_phase if beat_phase is not None else detected_phase
+
+    height = max(peak_summary(block).max() for block in read_blocks(source, block_frames)) * HEIGHT_RATIO
+    peaks, relevant = streamed_peaks(read_blocks(source, block_frames), info.n_frames, info.framerate, bpm,
+                                     height, amplitude_range, beat_phase)
+    markers = segment_markers(info.n_frames, info.framerate, bpm, beat_phase)
+    _, ends = segment_bounds(markers, info.n_frames)
+    warp = TimeWarp(*anchor_points(markers, ends, peaks, relevant, info.n_frames), info.n_frames)
+
+    def processed():
+        return warped_blocks(source, warp, block_frames, quality)
+
+    if normalization == 'two-pass':
+        peak = max(np.max(np.abs(block)) for block in processed())
+        gain = normalization_gain(peak)
+    elif normalization == 'running':
+        running_peak = 0.0
+
+        def gain(block):
+            nonlocal running_peak
+            running_peak = max(running_peak, np.max(np.abs(block)))
+            return normalization_gain(running_peak)  # Guadagno 1 finché si è sentito solo silenzio
+    else:
+        raise ValueError(f"Normalizzazione sconosciuta: {normalization}")
+
+    with wave.open(destination, 'w') as writer:
+        writer.setnchannels(info.n_channels)
+        writer.setsampwidth(2)
+        writer.setframerate(info.framerate)
+        write_normalized(writer, processed(), gain, info.framerate, info.n_channels)
+    return bpm, beat_phase
@@ -0,0 +1,255 @@
+"""Motore di riproduzione condiviso, basato su un OutputStream a callback.
+
+Un thread di alimentazione copia la sorgente (il buffer del documento o l'audio
+rielaborato, già in memoria) in un buffer circolare; la callback audio legge
+solo dal buffer circolare, senza lock. La riproduzione parte appena il primo
+blocco è nel buffer, senza convertire o copiare l'intero file. Ogni frame porta
+con sé la sua posizione nella sorgente, così il cursore resta esatto anche con
+il loop attivo e la sorgente si può sostituire durante la riproduzione.
+"""
+import threading
+
+import numpy as np
+import sounddevice as sd
+
+BLOCK_FRAMES = 512  # Frame per chiamata della callback (circa 12 ms a 44.1 kHz)
+RING_FRAMES = 8192  # Capacità del buffer circolare (circa 0.19 s a 44.1 kHz)
+FILL_INTERVAL = 0.01  # Secondi tra due riempimenti del buffer
+
+
+class RingBuffer:
+    """Buffer circolare di frame audio, con la posizione nella sorgente di ciascun frame.
+
+    Senza lock, per un solo produttore (che scrive con write e clear) e un solo
+    consumatore (la callback audio, che legge con read): il produttore aggiorna
+    solo write_index e skip_to, il consumatore solo read_index. Gli indici
+    crescono sempre e indicano la cella indice % capacity; ciascuno viene
+    aggiornato dopo aver copiato i dati, così l'altro thread vede solo frame
+    completi.
+    """
+
+    def __init__(self, capacity, n_channels):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, n_channels), dtype=np.float32)
+        self.positions = np.zeros(capacity, dtype=np.int64)
+        self.write_index = 0  # Frame scritti dall'inizio (solo il produttore lo modifica)
+        self.read_index = 0  # Frame letti dall'inizio (solo il consumatore lo modifica)
+        self.skip_to = 0  # I frame prima di questo indice sono stati scartati da clear()
+
+    def available(self):
+        """Frame pronti per la lettura."""
+        return max(0, self.write_index - max(self.read_index, self.skip_to))
+
+    def space(self):
+        # Conta anche i frame scartati ma non ancora saltati: il consumatore potrebbe starli copiando
+        return self.capacity - (self.write_index - self.read_index)
+
+    def write(self, frames, positions):
+        """Accoda quanti più frame possibile e restituisce quanti ne ha scritti."""
+        n = min(len(frames), self.space())
+        start = self.write_index % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start:start + first] = frames[:first]
+        self.positions[start:start + first] = positions[:first]
+        self.data[:n - first] = frames[first:n]
+        self.positions[:n - first] = positions[first:n]
+        self.write_index += n
+        return n
+
+    def read(self, out):
+        """Copia fino a len(out) frame in out; restituisce (frame letti, posizione dopo l'ultimo frame)."""
+        index = max(self.read_index, self.skip_to)
+        n = max(0, min(len(out), self.write_index - index))
+        start = index % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.data[start:start + first]
+        out[first:n] = self.data[:n - first]
+        after = None
+        if n:
+            after = int(self.positions[(index + n - 1) % self.capacity]) + 1
+        self.read_index = index + n
+        return n, after
+
+    def clear(self):
+        """Scarta i frame non ancora letti (lato produttore: il consumatore li salta alla prossima lettura)."""
+        self.skip_to = self.write_index
+
+
+class PlaybackEngine:
+    """Riproduce un array (frames, canali) o mono con seek, loop e lettura del cursore.
+
+    La sorgente può essere anche un oggetto che si comporta come un array a
+    fette (shape, dtype, ndim, len e [inizio:fine]), come EditedAudio.
+    """
+
+    def __init__(self, block_frames=BLOCK_FRAMES, ring_frames=RING_FRAMES):
+        self.block_frames = block_frames
+        self.ring_frames = ring_frames
+        self.lock = threading.Lock()  # Tra il thread dell'interfaccia e quello di alimentazione, mai nella callback
+        self.samples = None
+        self.framerate = None
+        self.scale = 1.0  # Fattore di conversione in float (1/32768 per int16)
+        self.stream = None
+        self.ring = None
+        self.feeder = None
+        self.read_position = 0  # Prossimo frame della sorgente da copiare nel buffer
+        self.playhead = 0  # Frame della sorgente appena inviato alla scheda audio
+        self.loop = None  # (inizio, fine) in frame, o None
+        self.source_done = False  # La sorgente è stata copiata tutta (senza loop)
+        self.status_count = 0  # Chiamate della callback con un avviso (underflow), riportate dal thread di alimentazione
+        self.last_status = None
+
+    @property
+    def active(self):
+        """True finché lo stream sta suonando."""
+        return self.stream is not None and self.stream.active
+
+    @property
+    def position(self):
+        """Posizione del cursore in secondi."""
+        return self.playhead / self.framerate if self.framerate else 0.0
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.framerate if self.samples is not None else 0.0
+
+    def set_source(self, samples, framerate):
+        """Imposta la sorgente; se sta suonando prosegue dallo stesso punto con il nuovo audio."""
+        if not hasattr(samples, 'shape'):
+            samples = np.asarray(samples)
+        if samples.ndim == 1:
+            samples = samples[:, np.newaxis]
+        same_format = (self.samples is not None and framerate == self.framerate
+                       and samples.shape[1] == self.samples.shape[1])
+        if self.active and not same_format:
+            # Frequenza o canali diversi: lo stream va riaperto
+            position = self.position
+            self.stop()
+            self._set_samples(samples, framerate)
+            self.play(position)
+            return
+        with self.lock:
+            self._set_samples(samples, framerate)
+            if self.ring is not None:
+                self._restart_from(self.playhead)
+
+    def play(self, start=None):
+        """Avvia la riproduzione da start secondi (None = posizione corrente)."""
+        if self.samples is None:
+            return
+        self.stop()
+        with self.lock:
+            self.ring = RingBuffer(self.ring_frames, self.samples.shape[1])
+            self.status_count = 0
+            position = self.playhead if start is None else int(start * self.framerate)
+            if position >= len(self.samples):
+                position = 0
+            self._restart_from(position)
+        self.stream = sd.OutputStream(
+            samplerate=self.framerate, channels=self.samples.shape[1], dtype='float32',
+            blocksize=self.block_frames, latency='low', callback=self._callback
+        )
+        self.stream.start()
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def stop(self):
+        """Ferma la riproduzione mantenendo la posizione del cursore."""
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            stream.stop()
+            stream.close()
+        if self.feeder is not None:
+            self.feeder.join()
+            self.feeder = None
+
+    def clear_source(self):
+        """Ferma la riproduzione e rilascia la sorgente (per esempio per chiudere un file mappato in memoria)."""
+        self.stop()
+        with self.lock:
+            self.samples = None
+            self.ring = None
+            self.loop = None
+            self.playhead = 0
+
+    def seek(self, seconds):
+        """Sposta il cursore; durante la riproduzione l'audio riprende subito dal nuovo punto."""
+        if self.samples is None:
+            return
+        with self.lock:
+            position = min(max(0, int(seconds * self.framerate)), len(self.samples))
+            self._restart_from(position)
+
+    def set_loop(self, start=None, stop=None):
+        """Ripete l'intervallo [start, stop) in secondi; senza argomenti disattiva il loop."""
+        loop = None
+        if start is not None and stop is not None and self.samples is not None:
+            first = min(max(0, int(start * self.framerate)), len(self.samples))
+            last = min(max(0, int(stop * self.framerate)), len(self.samples))
+            loop = (first, last) if last > first else None
+        with self.lock:
+            if loop == self.loop:
+                return
+            self.loop = loop
+            if self.ring is not None:
+                self._restart_from(self.playhead)
+
+    def _set_samples(self, samples, framerate):
+        self.samples = samples
+        self.framerate = framerate
+        self.scale = 1 / 32768 if samples.dtype == np.int16 else 1.0
+        self.playhead = min(self.playhead, len(samples))
+        if self.loop is not None and self.loop[1] > len(samples):
+            self.loop = None
+
+    def _restart_from(self, position):
+        """Scarta il buffer e lo riempie di nuovo da position (da chiamare con il lock)."""
+        if self.loop is not None and not self.loop[0] <= position < self.loop[1]:
+            position = self.loop[0]
+        self.read_position = position
+        self.playhead = position
+        self.source_done = False
+        if self.ring is not None:
+            self.ring.clear()
+            self._fill()
+
+    def _fill(self):
+        """Copia la sorgente nel buffer finché c'è spazio (da chiamare con il lock)."""
+        while self.ring.space() and not self.source_done:
+            end = self.loop[1] if self.loop is not None else len(self.samples)
+            stop = min(end, self.read_position + self.ring.space())
+            if stop > self.read_position:
+                frames = self.samples[self.read_position:stop].astype(np.float32) * self.scale
+                self.ring.write(frames, np.arange(self.read_position, stop))
+            self.read_position = stop
+            if self.read_position >= end:
+                if self.loop is None:
+                    self.source_done = True
+                else:
+                    self.read_position = self.loop[0]
+
+    def _feed(self):
+        reported = 0
+        while self.stream is not None and self.stream.active:
+            with self.lock:
+                self._fill()
+            count = self.status_count
+            if count != reported:
+                print(f"Riproduzione: {self.last_status} ({count - reported} blocchi)")
+                reported = count
+            sd.sleep(int(FILL_INTERVAL * 1000))
+
+    def _callback(self, outdata, frames, time, status):
+        # Nessun lock né I/O: un'attesa qui blocca il thread audio. Gli avvisi li stampa _feed
+        if status:
+            self.last_status = status
+            self.status_count += 1
+        n, after = self.ring.read(outdata)
+        if after is not None:
+            self.playhead = after
+        outdata[n:] = 0
+        # source_done viene impostato dopo l'ultima scrittura: se è True, available() è definitivo
+        if self.source_done and not self.ring.available():
+            if self.playhead >= len(self.samples):
+                self.playhead = 0  # La prossima riproduzione riparte dall'inizio
+            raise sd.CallbackStop
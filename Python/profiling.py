@@ -0,0 +1,151 @@
+"""Misura dei tempi delle fasi (span), con overlay sullo schermo ed export trace-event.
+
+La misura è disattivata per default e span() costa solo il controllo di una
+variabile; si attiva con la variabile d'ambiente UFFADUEVOLTE_PROFILE=1 o con
+enable() (nelle applicazioni: F12, che mostra anche l'overlay). Gli span
+completati finiscono in un buffer circolare di MAX_EVENTS elementi, letto
+dall'overlay e da export_trace(), che li scrive nel formato JSON Trace Event
+(apribile con chrome://tracing o https://ui.perfetto.dev).
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PROFILE_VARIABLE = 'UFFADUEVOLTE_PROFILE'  # Se impostata attiva la misura all'avvio
+TRACE_VARIABLE = 'UFFADUEVOLTE_TRACE'  # File in cui save_trace() esporta gli span alla chiusura
+MAX_EVENTS = 50000  # Span conservati (i più vecchi vengono scartati)
+OVERLAY_INTERVAL = 500  # Millisecondi tra due aggiornamenti dell'overlay
+OVERLAY_ROWS = 14  # Fasi mostrate nell'overlay, dalla più recente
+OVERLAY_EVENTS = 2000  # Span più recenti su cui l'overlay calcola media e massimo
+
+_enabled = bool(os.environ.get(PROFILE_VARIABLE))
+_events = deque(maxlen=MAX_EVENTS)  # (nome, inizio, durata, thread, argomenti); append è thread-safe
+
+
+def enabled():
+    return _enabled
+
+
+def enable(active=True):
+    """Attiva o disattiva la registrazione degli span."""
+    global _enabled
+    _enabled = active
+
+
+@contextmanager
+def span(name, **args):
+    """Misura il blocco with come fase name; args finiscono negli argomenti del trace."""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _events.append((name, start, time.perf_counter() - start, threading.get_ident(), args))
+
+
+def timed(name):
+    """Decoratore: misura ogni chiamata della funzione come fase name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_canvas(canvas, name='canvas.draw'):
+    """Misura ogni ridisegno del canvas matplotlib (anche quelli chiesti con draw_idle)."""
+    canvas.draw = timed(name)(canvas.draw)
+    return canvas
+
+
+def events():
+    """Copia degli span registrati, dal più vecchio."""
+    return list(_events)
+
+
+def take_events():
+    """Restituisce gli span registrati e svuota il buffer."""
+    taken = []
+    while _events:
+        taken.append(_events.popleft())
+    return taken
+
+
+def summary(recorded=None):
+    """Per ogni fase (numero di span, totale, ultimo, massimo) in secondi, dalla più recente."""
+    stats = {}
+    for name, _, duration, _, _ in recorded if recorded is not None else events():
+        count, total, _, longest = stats.pop(name, (0, 0.0, 0.0, 0.0))
+        stats[name] = (count + 1, total + duration, duration, max(longest, duration))
+    return dict(reversed(stats.items()))
+
+
+def trace_events(recorded=None, pid=None):
+    """Converte gli span in eventi completi ("ph": "X") del formato Trace Event, in microsecondi."""
+    pid = os.getpid() if pid is None else pid
+    return [
+        {'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': thread,
+         'args': {key: str(value) for key, value in args.items()}}
+        for name, start, duration, thread, args in (recorded if recorded is not None else events())
+    ]
+
+
+def export_trace(path, trace=None):
+    """Scrive in path gli eventi (di default quelli registrati in questo processo) come JSON Trace Event."""
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': trace if trace is not None else trace_events(), 'displayTimeUnit': 'ms'},
+                  trace_file)
+
+
+def save_trace():
+    """Se la variabile UFFADUEVOLTE_TRACE indica un file, vi esporta gli span registrati."""
+    path = os.environ.get(TRACE_VARIABLE)
+    if path and _events:
+        export_trace(path)
+        print(f"Trace dei tempi salvato in {path}")
+
+
+class TimingOverlay:
+    """Riquadro sopra il grafico con gli ultimi tempi per fase; è un widget Tk, quindi non ridisegna il grafico."""
+
+    def __init__(self, root, widget, interval=OVERLAY_INTERVAL):
+        import tkinter as tk
+        self.root = root
+        self.widget = widget  # Widget sopra cui mostrare l'overlay (il canvas o il suo contenitore)
+        self.interval = interval
+        self.label = tk.Label(widget, font=('Courier', 9), justify='left', anchor='nw',
+                              bg='black', fg='#80ff80', padx=6, pady=4)
+        self.visible = False
+        self.timer = None
+
+    def toggle(self, event=None):
+        """Mostra o nasconde l'overlay; mostrarlo attiva anche la registrazione degli span."""
+        if self.visible:
+            self.visible = False
+            self.label.place_forget()
+            if self.timer is not None:
+                self.root.after_cancel(self.timer)
+                self.timer = None
+        else:
+            enable()
+            self.visible = True
+            self.label.place(in_=self.widget, x=8, y=8, anchor='nw')
+            self.refresh()
+
+    def refresh(self):
+        lines = [f"{'fase':<22}{'ultimo':>9}{'medio':>9}{'max':>9}{'n':>6}"]
+        recent = events()[-OVERLAY_EVENTS:]
+        for name, (count, total, last, longest) in list(summary(recent).items())[:OVERLAY_ROWS]:
+            lines.append(f"{name[:21]:<22}{last * 1000:>7.1f}ms{total / count * 1000:>7.1f}ms"
+                         f"{longest * 1000:>7.1f}ms{count:>6}")
+        self.label.configure(text="\n".join(lines))
+        self.label.lift()  # Resta sopra anche a un canvas ricreato dopo l'overlay
+        self.timer = self.root.after(self.interval, self.refresh)
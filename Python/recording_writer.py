@@ -0,0 +1,63 @@
+"""Scrittura su disco di una registrazione mentre viene acquisita.
+
+La callback audio passa ogni blocco a put(), che non si blocca mai: i blocchi
+finiscono in una SimpleQueue e un thread dedicato li accoda a un SoundFile
+aperto, forzando la scrittura su disco ogni flush_interval secondi. La memoria
+usata resta quella dei pochi blocchi in coda, qualunque sia la durata, e in
+caso di crash sul file restano i campioni fino all'ultimo flush.
+"""
+import queue
+import threading
+import time
+
+import soundfile as sf
+
+FLUSH_INTERVAL = 1.0  # Secondi tra due scritture forzate su disco
+QUEUE_TIMEOUT = 0.1  # Attesa massima del thread di scrittura su una coda vuota
+
+
+class RecordingWriter:
+    """Thread che accoda al file i blocchi ricevuti dalla callback di registrazione."""
+
+    def __init__(self, path, samplerate, channels=1, subtype='PCM_16', flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.blocks = queue.SimpleQueue()  # put() non prende lock Python: sicura nella callback audio
+        self.file = sf.SoundFile(path, mode='w', samplerate=samplerate, channels=channels, subtype=subtype)
+        self.frames_written = 0
+        self.error = None  # Eccezione del thread di scrittura, se c'è stata
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def put(self, block):
+        """Da chiamare nella callback audio con una copia del blocco (frames, canali)."""
+        if self.error is None:  # Dopo un errore di scrittura la coda non deve crescere
+            self.blocks.put(block)
+
+    def close(self):
+        """Scrive i blocchi ancora in coda e chiude il file."""
+        self.blocks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    block = self.blocks.get(timeout=QUEUE_TIMEOUT)
+                except queue.Empty:
+                    block = ()  # Nessun dato: controlla solo se è ora di scrivere su disco
+                if block is None:
+                    break
+                if len(block):
+                    self.file.write(block)
+                    self.frames_written += len(block)
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    self.file.flush()
+                    last_flush = time.monotonic()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.file.close()
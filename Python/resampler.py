@@ -0,0 +1,140 @@
+"""Interpolatori usati per rendere la mappa temporale, in tre livelli di qualità.
+
+- draft: interpolazione lineare (2 campioni), per le prove interattive;
+- normal: sinc finestrata a 8 coefficienti letti da una tabella polifase
+  (512 fasi), il compromesso predefinito;
+- high: sinc finestrata (Kaiser) a 32 coefficienti, interpolati tra le fasi
+  di una tabella più fitta e con frequenza di taglio ridotta dove la mappa
+  comprime il tempo (anti-aliasing), per l'esportazione finale.
+
+Tutti leggono posizioni arbitrarie e variabili nel tempo, quindi non hanno
+giunture né effetti di bordo circolari come il ricampionamento via FFT.
+"""
+import numpy as np
+
+QUALITIES = ('draft', 'normal', 'high')  # Dal più veloce al più accurato
+DEFAULT_QUALITY = 'normal'
+CHUNK_FRAMES = 1 << 15  # Frame d'uscita interpolati per volta (limita la memoria dei coefficienti)
+POLYPHASE_PHASES = 512  # Posizioni frazionarie tabulate dal livello normal
+POLYPHASE_HALF_TAPS = 4  # Metà dei coefficienti del livello normal
+SINC_HALF_TAPS = 16  # Metà dei coefficienti del livello high
+SINC_PHASES = 1024  # Posizioni frazionarie tabulate dal livello high (interpolate linearmente)
+CUTOFF_STEP = 1 / 64  # Passo a cui si arrotonda (per difetto) la frequenza di taglio del livello high
+KAISER_BETA = 8.6  # Forma della finestra di Kaiser (circa 90 dB di attenuazione laterale)
+
+
+class Resampler:
+    """Interpola il segnale in posizioni frazionarie; usa i frame da floor(pos) - half_taps + 1 a floor(pos) + half_taps."""
+
+    half_taps = 1
+
+    def interpolate(self, samples, positions, slopes=None):
+        """Restituisce i frame (len(positions), canali) in float32.
+
+        slopes è la pendenza locale della mappa (frame della sorgente per frame
+        d'uscita), usata dagli interpolatori che filtrano quando la mappa comprime.
+        """
+        output = np.empty((len(positions), samples.shape[1]), dtype=np.float32)
+        for start in range(0, len(positions), CHUNK_FRAMES):
+            stop = start + CHUNK_FRAMES
+            output[start:stop] = self._interpolate(samples, positions[start:stop],
+                                                   None if slopes is None else slopes[start:stop])
+        return output
+
+    def _interpolate(self, samples, positions, slopes):
+        raise NotImplementedError
+
+
+class LinearResampler(Resampler):
+    """Livello draft: media pesata dei due frame vicini."""
+
+    def _interpolate(self, samples, positions, slopes):
+        index = np.floor(positions).astype(np.int64)
+        fraction = (positions - index).astype(np.float32)[:, np.newaxis]
+        before = _frames(samples, index)
+        after = _frames(samples, index + 1)
+        return before + (after - before) * fraction
+
+
+class PolyphaseResampler(Resampler):
+    """Livello normal: sinc finestrata con i coefficienti precalcolati per POLYPHASE_PHASES posizioni frazionarie."""
+
+    def __init__(self, half_taps=POLYPHASE_HALF_TAPS, phases=POLYPHASE_PHASES):
+        self.half_taps = half_taps
+        self.phases = phases
+        self.tables = {}  # Frequenza di taglio -> tabella (phases + 1, 2 * half_taps)
+
+    def table(self, cutoff=1.0):
+        """Coefficienti per ogni fase: la riga p interpola nella posizione floor(pos) + p / phases."""
+        if cutoff not in self.tables:
+            offsets = np.arange(-self.half_taps + 1, self.half_taps + 1)
+            distance = offsets[np.newaxis, :] - (np.arange(self.phases + 1) / self.phases)[:, np.newaxis]
+            table = np.sinc(cutoff * distance) * _kaiser(distance / self.half_taps)
+            self.tables[cutoff] = (table / table.sum(axis=1, keepdims=True)).astype(np.float32)  # Guadagno unitario
+        return self.tables[cutoff]
+
+    def _interpolate(self, samples, positions, slopes):
+        index = np.floor(positions).astype(np.int64)
+        phase = np.rint((positions - index) * self.phases).astype(np.int64)
+        return _weighted_sum(samples, index - self.half_taps + 1, self.table()[phase])
+
+
+class SincResampler(PolyphaseResampler):
+    """Livello high: tabella più lunga e fitta, fasi interpolate e anti-aliasing dove la mappa comprime."""
+
+    def __init__(self, half_taps=SINC_HALF_TAPS, phases=SINC_PHASES):
+        super().__init__(half_taps, phases)
+
+    def _interpolate(self, samples, positions, slopes):
+        index = np.floor(positions).astype(np.int64)
+        scaled = (positions - index) * self.phases
+        phase = np.minimum(scaled.astype(np.int64), self.phases - 1)
+        blend = (scaled - phase).astype(np.float32)[:, np.newaxis]
+        # Dove la sorgente scorre più veloce dell'uscita si taglia sotto la nuova frequenza di Nyquist
+        cutoff = np.ones(len(positions)) if slopes is None else np.minimum(1.0, 1.0 / np.maximum(slopes, 1e-9))
+        cutoff = np.maximum(np.floor(cutoff / CUTOFF_STEP), 1) * CUTOFF_STEP
+        weights = np.empty((len(positions), 2 * self.half_taps), dtype=np.float32)
+        for value in np.unique(cutoff):  # Pochi valori: la pendenza è costante tra due punti della mappa
+            rows = np.flatnonzero(cutoff == value)
+            table = self.table(value)
+            weights[rows] = table[phase[rows]] * (1 - blend[rows]) + table[phase[rows] + 1] * blend[rows]
+        return _weighted_sum(samples, index - self.half_taps + 1, weights)
+
+
+RESAMPLERS = {
+    'draft': LinearResampler,
+    'normal': PolyphaseResampler,
+    'high': SincResampler,
+}
+_instances = {}  # Un interpolatore per livello: la tabella polifase si calcola una volta
+
+
+def get_resampler(quality=DEFAULT_QUALITY):
+    """Restituisce l'interpolatore del livello indicato ('draft', 'normal' o 'high')."""
+    if quality not in _instances:
+        try:
+            _instances[quality] = RESAMPLERS[quality]()
+        except KeyError:
+            raise ValueError(f"Qualità di ricampionamento sconosciuta: {quality}") from None
+    return _instances[quality]
+
+
+def _frames(samples, index):
+    """Frame agli indici dati (limitati al segnale) in float32, con tutti i canali."""
+    return np.take(samples, np.clip(index, 0, len(samples) - 1), axis=0).astype(np.float32)
+
+
+def _weighted_sum(samples, first, weights):
+    """Per ogni uscita, somma dei frame first, first + 1, ... pesati con la riga corrispondente di weights."""
+    output = np.zeros((len(first), samples.shape[1]), dtype=np.float32)
+    last = len(samples) - 1
+    for tap in range(weights.shape[1]):
+        # Il prodotto con i pesi float32 converte i campioni senza una copia intermedia
+        output += weights[:, tap, np.newaxis] * np.take(samples, np.clip(first + tap, 0, last), axis=0)
+    return output
+
+
+def _kaiser(x, beta=KAISER_BETA):
+    """Finestra di Kaiser valutata in x (in [-1, 1]; zero fuori)."""
+    inside = np.clip(1 - np.square(x), 0, None)
+    return np.where(np.abs(x) <= 1, np.i0(beta * np.sqrt(inside)) / np.i0(beta), 0.0)
@@ -0,0 +1,133 @@
+"""Sessione salvata accanto al file audio, per riaprirlo senza ripetere le analisi.
+
+Il file di sessione (nome dell'audio + SESSION_SUFFIX, oppure in SESSION_DIR se
+la cartella dell'audio non è scrivibile) è un archivio .npz non compresso con:
+- la firma (dimensione, mtime) del file audio: se il file cambia, la sessione
+  viene ignorata;
+- lo stato di ogni applicazione (BPM, marker, range, tempo rilevato, cronologia
+  annulla/ripeti) in JSON, sotto il nome dell'applicazione;
+- le analisi costose: la piramide della forma d'onda e l'indice dei picchi.
+
+load_session() installa le analisi tra i dati derivati del documento, così
+pyramid() e derived('peak_index', ...) le restituiscono senza ricalcolarle, e
+restituisce lo stato dell'applicazione. Le liste JSON tornano tuple, come gli
+stati immutabili conservati nella cronologia.
+"""
+import hashlib
+import json
+import os
+import threading
+import zipfile
+
+import numpy as np
+
+from audio_document import CACHE_DIR
+from peak_stretch import PeakIndex
+from profiling import span
+from waveform_pyramid import WaveformPyramid
+
+SESSION_SUFFIX = ".uffaduevolte"  # Aggiunto al nome del file audio
+SESSION_DIR = os.path.join(CACHE_DIR, "sessions")  # Sessioni dei file in cartelle non scrivibili
+SESSION_VERSION = 1  # Cambia quando cambia il contenuto dell'archivio
+
+
+def session_paths(path):
+    """Percorsi possibili della sessione: accanto al file audio e, in alternativa, nella cache."""
+    name = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=16).hexdigest()
+    return f"{path}{SESSION_SUFFIX}", os.path.join(SESSION_DIR, f"{name}{SESSION_SUFFIX}")
+
+
+def load_session(document, app):
+    """Installa nel documento le analisi salvate e restituisce lo stato di app, o None senza sessione valida."""
+    for path in session_paths(document.path):
+        if not os.path.exists(path):
+            continue
+        with span('session load'):
+            try:
+                with np.load(path) as archive:
+                    states = _read_archive(archive, document)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                print(f"Sessione non leggibile ({path}): {e}")
+                continue
+        if states is not None:
+            return _tuples(states.get(app))
+    return None
+
+
+def save_session(document, app, state):
+    """Salva lo stato di app (dizionario serializzabile in JSON) e le analisi già calcolate del documento."""
+    with span('session save'):
+        states = _stored_states(document)
+        states[app] = state
+        arrays = {
+            'version': np.array(SESSION_VERSION),
+            'signature': np.array(document.signature, dtype=np.int64),
+            'state': np.array(json.dumps(states)),
+        }
+        pyramid = document.cached('pyramid')
+        if pyramid is not None:
+            arrays['pyramid_buckets'] = np.array([level[0] for level in pyramid.levels], dtype=np.int64)
+            for number, (_, mins, maxs, squares) in enumerate(pyramid.levels):
+                arrays[f'pyramid_{number}_mins'] = mins
+                arrays[f'pyramid_{number}_maxs'] = maxs
+                arrays[f'pyramid_{number}_squares'] = squares
+        peak_index = document.cached('peak_index')
+        if peak_index is not None:
+            arrays['peaks_min_height'] = np.array(peak_index.min_height)
+            arrays['peaks_positions'] = peak_index.positions
+            arrays['peaks_heights'] = peak_index.heights
+
+        for path in session_paths(document.path):
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                # Scrittura atomica: una sessione scritta a metà non sostituisce quella precedente
+                temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temporary_path, 'wb') as session_file:
+                    np.savez(session_file, **arrays)
+                os.replace(temporary_path, path)
+                return path
+            except OSError as e:
+                print(f"Impossibile salvare la sessione in {path}: {e}")
+    return None
+
+
+def _read_archive(archive, document):
+    """Stati delle applicazioni di un archivio valido per il documento (installando le analisi), o None."""
+    if int(archive['version']) != SESSION_VERSION:
+        return None
+    if tuple(int(value) for value in archive['signature']) != tuple(document.signature):
+        return None  # Il file audio è cambiato dopo il salvataggio
+    if 'pyramid_buckets' in archive.files and document.cached('pyramid') is None:
+        levels = [(int(bucket), archive[f'pyramid_{number}_mins'], archive[f'pyramid_{number}_maxs'],
+                   archive[f'pyramid_{number}_squares'])
+                  for number, bucket in enumerate(archive['pyramid_buckets'])]
+        document.provide('pyramid', WaveformPyramid.from_levels(document.samples, document.framerate, levels))
+    if 'peaks_positions' in archive.files and document.cached('peak_index') is None:
+        document.provide('peak_index', PeakIndex.restore(
+            document.samples, document.framerate, archive['peaks_min_height'], archive['peaks_positions'],
+            archive['peaks_heights']))
+    return json.loads(str(archive['state']))
+
+
+def _stored_states(document):
+    """Stati già salvati per il documento (anche di altre applicazioni), da conservare al salvataggio."""
+    for path in session_paths(document.path):
+        if not os.path.exists(path):
+            continue
+        try:
+            with np.load(path) as archive:
+                if (int(archive['version']) == SESSION_VERSION
+                        and tuple(int(value) for value in archive['signature']) == tuple(document.signature)):
+                    return json.loads(str(archive['state']))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass
+    return {}
+
+
+def _tuples(value):
+    """Converte ricorsivamente le liste lette dal JSON in tuple."""
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _tuples(item) for key, item in value.items()}
+    return value
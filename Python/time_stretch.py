@@ -0,0 +1,192 @@
+"""Motori di time-stretch che preservano l'intonazione, elaborati un hop alla volta.
+
+Ogni motore riceve, per ogni hop di uscita, la posizione (in frame della
+sorgente) del centro della finestra di analisi e restituisce i campioni di
+quell'hop. Le posizioni possono cambiare liberamente da un hop all'altro, così
+lo stesso motore serve sia per allungare un segmento a lunghezza fissa
+(stretch) sia per seguire una mappa temporale o un controllo in tempo reale
+(stretch_stream).
+
+Fattore tempo reale misurato su un core (44.1 kHz mono, fattore 0.8-1.25):
+    WSOLA          circa 0.01 (100 volte più veloce del tempo reale)
+    phase vocoder  circa 0.02 (50 volte più veloce del tempo reale)
+WSOLA è adatto all'anteprima dal vivo; il phase vocoder dà meno artefatti
+sui suoni tonali ed è pensato per l'esportazione.
+"""
+import numpy as np
+
+PROGRESS_HOPS = 256  # Hop elaborati tra due chiamate di progress
+NCC_TOLERANCE = 1e-9  # Scarto relativo entro cui WSOLA preferisce lo spostamento nullo
+
+
+class _OverlapAdd:
+    """Somma le finestre di sintesi e restituisce un hop di campioni definitivi alla volta."""
+
+    def __init__(self, frame_length, hop):
+        self.frame_length = frame_length
+        self.hop = hop
+        self.accumulator = None
+
+    def add(self, frame):
+        if self.accumulator is None:
+            self.accumulator = np.zeros((self.frame_length, frame.shape[1]))
+        self.accumulator += frame
+        output = self.accumulator[:self.hop].copy()
+        self.accumulator[:-self.hop] = self.accumulator[self.hop:]
+        self.accumulator[-self.hop:] = 0
+        return output
+
+    def flush(self):
+        """Restituisce il prossimo hop senza aggiungere nuove finestre."""
+        return self.add(np.zeros_like(self.accumulator))
+
+
+class WSOLAStretcher:
+    """Waveform Similarity Overlap-Add: sceglie ogni finestra di analisi per continuità di forma d'onda."""
+
+    name = 'wsola'
+
+    def __init__(self, frame_length=1024, tolerance=256):
+        self.frame_length = frame_length
+        self.hop = frame_length // 2  # Finestre di Hann al 50% sommano a 1
+        self.tolerance = tolerance  # Spostamento massimo della finestra di analisi, in frame
+        self.window = np.hanning(frame_length + 1)[:-1][:, np.newaxis]
+        self.reset()
+
+    def reset(self):
+        self.previous_start = None  # Inizio della finestra scelta all'hop precedente
+        self.output = _OverlapAdd(self.frame_length, self.hop)
+
+    def process_hop(self, source, start):
+        """Restituisce il prossimo hop; start è l'inizio della finestra di analisi nella sorgente con padding."""
+        n = self.frame_length
+        if self.previous_start is not None:
+            # Cerca lo scostamento che meglio continua la finestra scelta in precedenza
+            natural = _mono(source[self.previous_start + self.hop:self.previous_start + self.hop + n])
+            region = _mono(source[start - self.tolerance:start + self.tolerance + n])
+            # Correlazione normalizzata: divisa per l'energia di ogni finestra candidata, così
+            # conta la somiglianza di forma e non il volume (le zone forti non vincono da sole)
+            energy = np.cumsum(np.concatenate(([0.0], np.square(region))))
+            norms = np.sqrt(np.maximum(energy[n:] - energy[:-n], 0))
+            similarity = np.correlate(region, natural, mode='valid') / np.maximum(norms, 1e-12)
+            best = int(np.argmax(similarity))
+            # A parità (entro l'arrotondamento) si resta sulla continuazione naturale: a fattore 1.0
+            # l'uscita è la sorgente, anche sui segnali periodici che hanno un massimo a ogni periodo
+            if similarity[self.tolerance] >= similarity[best] * (1 - NCC_TOLERANCE):
+                best = self.tolerance
+            start += best - self.tolerance
+        self.previous_start = start
+        return self.output.add(source[start:start + n] * self.window)
+
+    def flush(self):
+        return self.output.flush()
+
+
+class PhaseVocoderStretcher:
+    """Phase vocoder: mantiene il modulo dello spettro e fa avanzare la fase di un hop di sintesi per bin."""
+
+    name = 'phase-vocoder'
+
+    def __init__(self, frame_length=2048, overlap=4):
+        self.frame_length = frame_length
+        self.hop = frame_length // overlap
+        self.tolerance = self.hop  # Margine per la finestra precedente usata nella stima di fase
+        self.window = np.hanning(frame_length + 1)[:-1][:, np.newaxis]
+        # Normalizzazione della somma delle finestre di analisi e sintesi (Hann al quadrato)
+        self.gain = self.hop / np.sum(self.window ** 2)
+        self.reset()
+
+    def reset(self):
+        self.phase = None  # Fase accumulata per bin e canale
+        self.output = _OverlapAdd(self.frame_length, self.hop)
+
+    def process_hop(self, source, start):
+        """Restituisce il prossimo hop; start è l'inizio della finestra di analisi nella sorgente con padding."""
+        n = self.frame_length
+        current = np.fft.rfft(source[start:start + n] * self.window, axis=0)
+        if self.phase is None:
+            self.phase = np.angle(current)
+        else:
+            # Avanzamento di fase della sorgente su esattamente un hop di sintesi, misurato qui
+            preceding = np.fft.rfft(source[start - self.hop:start - self.hop + n] * self.window, axis=0)
+            self.phase += np.angle(current) - np.angle(preceding)
+        frame = np.fft.irfft(np.abs(current) * np.exp(1j * self.phase), n=n, axis=0)
+        return self.output.add(frame * self.window * self.gain)
+
+    def flush(self):
+        return self.output.flush()
+
+
+ENGINES = {
+    WSOLAStretcher.name: WSOLAStretcher,
+    PhaseVocoderStretcher.name: PhaseVocoderStretcher,
+}
+
+
+def create_stretcher(engine):
+    """Crea il motore indicato per nome ('wsola' o 'phase-vocoder')."""
+    try:
+        return ENGINES[engine]()
+    except KeyError:
+        raise ValueError(f"Motore di time-stretch sconosciuto: {engine}") from None
+
+
+def stretch_stream(samples, positions, engine='wsola'):
+    """Genera l'uscita un hop alla volta; positions dà, per ogni hop, il centro di analisi nella sorgente.
+
+    positions può essere un generatore calcolato al volo (per esempio da un
+    controllo di velocità in tempo reale). I blocchi escono come array
+    (hop, canali) e il primo campione è centrato sulla prima posizione.
+    """
+    stretcher = create_stretcher(engine) if isinstance(engine, str) else engine
+    stretcher.reset()
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+
+    # Silenzio ai bordi: ogni finestra, anche spostata dalla ricerca, resta dentro la sorgente
+    half = stretcher.frame_length // 2
+    margin = stretcher.frame_length + stretcher.tolerance
+    source = np.pad(samples, ((margin, margin + stretcher.frame_length), (0, 0)))
+
+    # L'uscita della prima finestra è centrata mezzo frame dopo l'inizio: si scartano gli hop di attacco
+    skip = half // stretcher.hop
+    for index, position in enumerate(positions):
+        position = min(max(int(round(position)), -half), len(samples) + half)
+        output = stretcher.process_hop(source, margin + position - half)
+        if index >= skip:
+            yield output
+    for _ in range(skip):
+        yield stretcher.flush()
+
+
+def stretch(samples, target_length, engine='wsola'):
+    """Allunga o comprime il segnale a target_length frame senza cambiarne l'intonazione."""
+    stretcher = create_stretcher(engine) if isinstance(engine, str) else engine
+    samples = np.asarray(samples)
+    n_hops = -(-target_length // stretcher.hop) + 1
+    positions = np.arange(n_hops) * stretcher.hop * (len(samples) / max(target_length, 1))
+    output = np.concatenate(list(stretch_stream(samples, positions, stretcher)))[:target_length]
+    return output[:, 0] if samples.ndim == 1 else output
+
+
+def stretch_map(samples, target_points, source_points, target_length, engine='wsola', progress=None):
+    """Rende il segnale seguendo una mappa temporale a tratti lineare (target -> sorgente, in frame).
+
+    progress, se indicata, riceve ogni PROGRESS_HOPS hop la frazione completata.
+    """
+    stretcher = create_stretcher(engine) if isinstance(engine, str) else engine
+    samples = np.asarray(samples)
+    n_hops = -(-target_length // stretcher.hop) + 1
+    positions = np.interp(np.arange(n_hops) * stretcher.hop, target_points, source_points)
+    blocks = []
+    for index, block in enumerate(stretch_stream(samples, positions, stretcher)):
+        blocks.append(block)
+        if progress is not None and index % PROGRESS_HOPS == 0:
+            progress(index / n_hops)
+    output = np.concatenate(blocks)[:target_length]
+    return output[:, 0] if samples.ndim == 1 else output
+
+
+def _mono(frames):
+    return frames.sum(axis=1)
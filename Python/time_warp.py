@@ -0,0 +1,89 @@
+"""Mappa temporale globale (uscita -> sorgente) lineare a tratti e monotona.
+
+Le coppie marker -> picco di Adjust formano un'unica mappa su tutto il file:
+ogni frame d'uscita legge la sorgente nella posizione data dalla mappa, con
+l'interpolatore del livello di qualità scelto (vedi resampler.py). Il rendering
+è un'unica operazione vettoriale per blocco, senza giunture tra segmenti; quando cambia
+solo una parte dei punti di ancoraggio, render_warp() ricalcola soltanto
+l'intervallo d'uscita interessato (changed_span).
+"""
+import numpy as np
+
+from profiling import timed
+from resampler import DEFAULT_QUALITY, get_resampler
+
+BLOCK_FRAMES = 1 << 18  # Frame d'uscita calcolati per volta (limita la memoria temporanea)
+
+
+class TimeWarp:
+    """Mappa dai frame d'uscita ai frame della sorgente, interpolata tra i punti (targets, sources)."""
+
+    def __init__(self, targets, sources, n_frames):
+        self.targets = np.asarray(targets, dtype=np.float64)
+        self.sources = np.asarray(sources, dtype=np.float64)
+        if np.any(np.diff(self.targets) <= 0) or np.any(np.diff(self.sources) < 0):
+            raise ValueError("La mappa temporale deve essere monotona")
+        self.n_frames = n_frames  # Lunghezza dell'uscita
+
+    def positions(self, start, stop):
+        """Posizioni (frazionarie) nella sorgente dei frame d'uscita [start, stop)."""
+        return np.interp(np.arange(start, stop), self.targets, self.sources)
+
+    def slopes(self, start, stop):
+        """Pendenza della mappa (frame della sorgente per frame d'uscita) nei frame d'uscita [start, stop)."""
+        if len(self.targets) < 2:
+            return np.ones(stop - start)
+        segment_slopes = np.diff(self.sources) / np.diff(self.targets)
+        segment = np.searchsorted(self.targets, np.arange(start, stop), side='right') - 1
+        return segment_slopes[np.clip(segment, 0, len(segment_slopes) - 1)]
+
+    def source_range(self, start, stop, half_taps=1):
+        """Frame della sorgente [first, last) letti per rendere l'uscita [start, stop) con half_taps frame per lato."""
+        first, last = np.interp((start, stop - 1), self.targets, self.sources)
+        return max(0, int(first) - half_taps + 1), int(last) + half_taps + 1
+
+    def changed_span(self, other):
+        """Intervallo d'uscita [start, stop) in cui questa mappa differisce da other, None se coincidono."""
+        if other.n_frames != self.n_frames:
+            return 0, self.n_frames
+        # Tra due punti consecutivi (di una o dell'altra mappa) entrambe sono lineari:
+        # differiscono in un tratto solo se differiscono in uno dei suoi estremi
+        knots = np.union1d(np.union1d(self.targets, other.targets), (0, self.n_frames))
+        changed = np.flatnonzero(np.interp(knots, self.targets, self.sources)
+                                 != np.interp(knots, other.targets, other.sources))
+        if len(changed) == 0:
+            return None
+        start = knots[max(changed[0] - 1, 0)]
+        stop = knots[min(changed[-1] + 1, len(knots) - 1)]
+        return max(0, int(np.floor(start))), min(self.n_frames, int(np.ceil(stop)) + 1)
+
+    def render(self, samples, start, stop, offset=0, quality=DEFAULT_QUALITY):
+        """Frame d'uscita [start, stop) in float32; samples contiene la sorgente a partire dal frame offset."""
+        positions = np.clip(self.positions(start, stop) - offset, 0, len(samples) - 1)
+        return get_resampler(quality).interpolate(samples, positions, self.slopes(start, stop))
+
+
+@timed('time warp')
+def render_warp(samples, warp, previous=None, progress=None, block_frames=BLOCK_FRAMES,
+                quality=DEFAULT_QUALITY):
+    """Rende tutta l'uscita della mappa come array (frames, canali) float32.
+
+    previous è la coppia (mappa, uscita) di un rendering precedente dello stesso
+    segnale e livello di qualità: le parti in cui la mappa non è cambiata vengono copiate. progress,
+    se indicata, riceve la frazione completata dopo ogni blocco.
+    """
+    output = np.empty((warp.n_frames, samples.shape[1]), dtype=np.float32)
+    start, stop = 0, warp.n_frames
+    if previous is not None and previous[1].shape == output.shape:
+        previous_warp, previous_output = previous
+        changed = warp.changed_span(previous_warp)
+        if changed is None:
+            return previous_output
+        output[:] = previous_output
+        start, stop = changed
+    for first in range(start, stop, block_frames):
+        last = min(stop, first + block_frames)
+        output[first:last] = warp.render(samples, first, last, quality=quality)
+        if progress is not None:
+            progress((last - start) / (stop - start))
+    return output
@@ -0,0 +1,98 @@
+"""Lettura dei file WAV (RIFF e RF64) come np.memmap, senza copiare i campioni.
+
+L'intestazione viene letta una volta per trovare formato e posizione del
+chunk data; i campioni restano sul disco e il sistema operativo carica solo
+le pagine effettivamente lette (la parte visualizzata o elaborata). Gestisce
+i file oltre 4 GB: RF64 con il chunk ds64, e RIFF scritti senza dimensione
+(0xFFFFFFFF) o con una dimensione che ha superato i 32 bit.
+"""
+import os
+import struct
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+UNKNOWN_SIZE = 0xFFFFFFFF  # Dimensione di chunk non nota (RF64 o registrazione interrotta)
+
+# (formato, bit per campione) -> dtype mappabile direttamente
+MAPPABLE_DTYPES = {
+    (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8'),
+}
+
+
+class WavLayout:
+    """Formato dei campioni e posizione del chunk data all'interno del file."""
+
+    def __init__(self, framerate, n_channels, format_tag, bits, block_align, data_offset, data_size):
+        self.framerate = framerate
+        self.n_channels = n_channels
+        self.format_tag = format_tag
+        self.bits = bits
+        self.block_align = block_align
+        self.data_offset = data_offset
+        self.n_frames = data_size // block_align
+
+    @property
+    def dtype(self):
+        """dtype numpy dei campioni, o None se non si possono mappare (per esempio 24 bit)."""
+        dtype = MAPPABLE_DTYPES.get((self.format_tag, self.bits))
+        if dtype is None or dtype.itemsize * self.n_channels != self.block_align:
+            return None
+        return dtype
+
+
+def read_layout(path):
+    """Legge l'intestazione RIFF/RF64 e restituisce il WavLayout del file."""
+    with open(path, 'rb') as wav_file:
+        file_size = os.fstat(wav_file.fileno()).st_size
+        riff, _, wave_id = struct.unpack('<4sI4s', wav_file.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+            raise ValueError(f"{path} non è un file WAV")
+
+        ds64_data_size = None
+        fmt = None
+        while True:
+            header = wav_file.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path}: chunk data mancante")
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            start = wav_file.tell()
+
+            if chunk_id == b'ds64':
+                # Dimensioni a 64 bit di RIFF e data (RF64)
+                _, ds64_data_size = struct.unpack('<QQ', wav_file.read(16))
+            elif chunk_id == b'fmt ':
+                body = wav_file.read(chunk_size)
+                format_tag, n_channels, framerate, _, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    # Il formato effettivo sono i primi due byte del GUID SubFormat
+                    format_tag = struct.unpack('<H', body[24:26])[0]
+                fmt = (framerate, n_channels, format_tag, bits, block_align)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f"{path}: chunk fmt mancante prima dei dati")
+                available = file_size - start
+                if riff == b'RF64' and chunk_size == UNKNOWN_SIZE and ds64_data_size is not None:
+                    data_size = ds64_data_size
+                elif chunk_size == UNKNOWN_SIZE or available > UNKNOWN_SIZE:
+                    # RIFF senza dimensione o oltre 4 GB: i dati arrivano fino alla fine del file
+                    data_size = available
+                else:
+                    data_size = chunk_size
+                return WavLayout(*fmt, start, min(data_size, available))
+
+            wav_file.seek(start + chunk_size + (chunk_size & 1))  # I chunk sono allineati a 2 byte
+
+
+def map_samples(path, layout=None):
+    """Restituisce i campioni come np.memmap (frames, canali) in sola lettura, o None se non mappabili."""
+    layout = layout or read_layout(path)
+    if layout.dtype is None or layout.n_frames == 0:
+        return None
+    return np.memmap(path, dtype=layout.dtype, mode='r', offset=layout.data_offset,
+                     shape=(layout.n_frames, layout.n_channels))
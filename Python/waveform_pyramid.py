@@ -0,0 +1,109 @@
+"""Piramide multi-risoluzione min/max/RMS della forma d'onda.
+
+Ogni livello riassume il segnale in bucket di dimensione crescente (BASE_BUCKET,
+BASE_BUCKET * LEVEL_FACTOR, ...). Per disegnare si sceglie il livello con circa
+un bucket per pixel, così il costo del ridisegno dipende dalla larghezza dello
+schermo e non dalla lunghezza del file.
+"""
+import numpy as np
+
+from profiling import timed
+
+BASE_BUCKET = 64  # Frame per bucket nel livello più fine
+LEVEL_FACTOR = 4  # Rapporto tra le dimensioni dei bucket di due livelli consecutivi
+CHUNK_BUCKETS = 16384  # Bucket elaborati per volta durante la costruzione
+
+
+class WaveformPyramid:
+    """Min, max e valore quadratico medio del segnale per ogni livello di dettaglio."""
+
+    @timed('waveform pyramid')
+    def __init__(self, samples, framerate, base_bucket=BASE_BUCKET, factor=LEVEL_FACTOR):
+        samples = np.asarray(samples)
+        if samples.ndim == 1:
+            samples = samples[:, np.newaxis]
+        self.samples = samples  # Array (frames, canali), usato per lo zoom massimo
+        self.framerate = framerate
+        self.n_frames = len(samples)
+        self.levels = []  # Lista di (dimensione bucket, mins, maxs, quadrati medi)
+
+        bucket = base_bucket
+        mins, maxs, squares = _reduce_frames(samples, bucket)
+        self.levels.append((bucket, mins, maxs, squares))
+        while len(mins) > factor:
+            starts = np.arange(0, len(mins), factor)
+            counts = np.diff(np.append(starts, len(mins)))
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+            squares = np.add.reduceat(squares, starts) / counts
+            bucket *= factor
+            self.levels.append((bucket, mins, maxs, squares))
+
+    @classmethod
+    def from_levels(cls, samples, framerate, levels):
+        """Piramide già calcolata (per esempio letta da una sessione) per i campioni dati."""
+        pyramid = cls.__new__(cls)
+        pyramid.samples = samples[:, np.newaxis] if samples.ndim == 1 else samples
+        pyramid.framerate = framerate
+        pyramid.n_frames = len(pyramid.samples)
+        pyramid.levels = list(levels)
+        return pyramid
+
+    @property
+    def duration(self):
+        return self.n_frames / self.framerate
+
+    def limits(self):
+        """Ampiezza minima e massima dell'intero segnale."""
+        _, mins, maxs, _ = self.levels[-1]
+        if len(mins) == 0:
+            return 0, 0
+        return mins.min(), maxs.max()
+
+    def envelope(self, start, stop, width):
+        """Restituisce (frame iniziali, mins, maxs, rms) per i frame [start, stop) su width pixel."""
+        start = max(0, int(start))
+        stop = min(self.n_frames, int(np.ceil(stop)))
+        if stop <= start:
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+        frames_per_pixel = (stop - start) / max(1, int(width))
+
+        if frames_per_pixel < self.levels[0][0]:
+            # Zoom molto ravvicinato: pochi frame visibili, si usano i campioni originali
+            chunk = self.samples[start:stop]
+            squares = np.mean(np.square(chunk, dtype=np.float64), axis=1)
+            return np.arange(start, stop), chunk.min(axis=1), chunk.max(axis=1), np.sqrt(squares)
+
+        level = self.levels[0]
+        for candidate in self.levels:
+            if candidate[0] > frames_per_pixel:
+                break
+            level = candidate
+        bucket, mins, maxs, squares = level
+        first = start // bucket
+        last = -(-stop // bucket)
+        positions = np.arange(first, last) * bucket
+        return positions, mins[first:last], maxs[first:last], np.sqrt(squares[first:last])
+
+
+def _reduce_frames(samples, bucket):
+    """Calcola min, max e quadrato medio per bucket di frame, a blocchi per limitare la memoria."""
+    n_frames = len(samples)
+    n_buckets = -(-n_frames // bucket)
+    mins = np.empty(n_buckets, dtype=samples.dtype)
+    maxs = np.empty(n_buckets, dtype=samples.dtype)
+    squares = np.empty(n_buckets, dtype=np.float64)
+
+    step = bucket * CHUNK_BUCKETS
+    for offset in range(0, n_frames, step):
+        chunk = samples[offset:offset + step]
+        starts = np.arange(0, len(chunk), bucket)
+        counts = np.diff(np.append(starts, len(chunk))) * chunk.shape[1]
+        index = offset // bucket
+        flat_starts = starts * chunk.shape[1]
+        flat = chunk.reshape(-1)
+        mins[index:index + len(starts)] = np.minimum.reduceat(flat, flat_starts)
+        maxs[index:index + len(starts)] = np.maximum.reduceat(flat, flat_starts)
+        squares[index:index + len(starts)] = np.add.reduceat(np.square(flat, dtype=np.float64), flat_starts) / counts
+    return mins, maxs, squares
@@ -0,0 +1,162 @@
+"""Artisti matplotlib che disegnano la forma d'onda a partire dalla piramide min/max."""
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.patches import Polygon
+
+from profiling import timed
+
+
+class WaveformView:
+    """Linea a zig-zag min/max che mostra solo il livello adatto alla larghezza dell'asse."""
+
+    def __init__(self, ax, pyramid, color='orange', label=None, alpha=1.0, show_rms=False):
+        self.ax = ax
+        self.pyramid = pyramid
+        self.line, = ax.plot([], [], color=color, label=label, alpha=alpha, linewidth=0.8)
+        self.rms_line = None
+        if show_rms:
+            self.rms_line, = ax.plot([], [], color=color, alpha=min(1.0, alpha + 0.3), linewidth=0.8)
+
+        # Limiti del grafico calcolati dalla piramide, senza passare da tutti i campioni
+        ymin, ymax = pyramid.limits()
+        ax.update_datalim([(0, ymin), (pyramid.duration, ymax)])
+        ax.autoscale_view()
+        ax.callbacks.connect('xlim_changed', lambda axes: self.refresh())
+        self.refresh()
+
+    @timed('waveform envelope')
+    def refresh(self):
+        """Ricalcola i vertici per l'intervallo di tempo visibile."""
+        framerate = self.pyramid.framerate
+        x0, x1 = self.ax.get_xlim()
+        width = self.ax.get_window_extent().width
+        positions, mins, maxs, rms = self.pyramid.envelope(x0 * framerate, x1 * framerate, width)
+
+        times = np.repeat(positions / framerate, 2)
+        self.line.set_data(times, _zigzag(mins, maxs))
+        if self.rms_line is not None:
+            self.rms_line.set_data(times, _zigzag(-rms, rms))
+
+
+class BeatGrid:
+    """Griglia BPM disegnata come un'unica LineCollection, limitata ai battiti visibili."""
+
+    def __init__(self, ax, interval, duration, offset=0.0, color='red', linestyle='--', alpha=1.0, label=None):
+        self.ax = ax
+        self.interval = interval  # Secondi tra due battiti
+        self.duration = duration  # Durata del file: nessun battito oltre la fine
+        self.offset = offset  # Posizione del primo battito in secondi
+        self.collection = LineCollection(
+            [], colors=color, linestyles=linestyle, alpha=alpha, label=label,
+            transform=ax.get_xaxis_transform()  # x in secondi, y da 0 a 1 come axvline
+        )
+        ax.add_collection(self.collection, autolim=False)
+        ax.callbacks.connect('xlim_changed', lambda axes: self.refresh())
+        self.refresh()
+
+    def set_interval(self, interval, offset=None):
+        """Aggiorna la griglia sul posto quando cambia il BPM."""
+        self.interval = interval
+        if offset is not None:
+            self.offset = offset
+        self.refresh()
+
+    def positions(self, start=0.0, stop=None):
+        """Posizioni dei battiti in secondi comprese tra start e stop."""
+        stop = self.duration if stop is None else min(stop, self.duration)
+        first = max(0, int(np.ceil((start - self.offset) / self.interval)))
+        last = int(np.ceil((stop - self.offset) / self.interval))  # Escluso, come np.arange
+        return self.offset + np.arange(first, max(first, last)) * self.interval
+
+    @timed('beat grid')
+    def refresh(self):
+        """Ricalcola i segmenti per l'intervallo di tempo visibile."""
+        x0, x1 = self.ax.get_xlim()
+        beats = self.positions(x0, x1)
+        segments = np.empty((len(beats), 2, 2))
+        segments[:, :, 0] = beats[:, np.newaxis]
+        segments[:, 0, 1] = 0
+        segments[:, 1, 1] = 1
+        self.collection.set_segments(segments)
+
+
+class LiveWaveformView:
+    """Forma d'onda scorrevole e indicatori di livello aggiornati con il blitting durante la registrazione.
+
+    Ogni aggiornamento ridisegna solo gli artisti animati sullo sfondo salvato,
+    con un numero fisso di vertici (due per bucket dello storico). Min/max e RMS
+    sono poligoni pieni: con Agg riempire costa circa la metà che tracciare una
+    linea a zig-zag con lo stesso numero di vertici.
+    """
+
+    def __init__(self, ax, history, color='orange'):
+        self.ax = ax
+        self.history = history
+        self.canvas = ax.figure.canvas
+        self.background = None
+        times = (np.arange(history.capacity) - history.capacity + 1) * history.bucket_seconds
+        self.vertices = np.empty((2 * history.capacity, 2))
+        self.vertices[:, 0] = np.concatenate((times, times[::-1]))  # Bordo superiore, poi inferiore all'indietro
+
+        self.envelope = Polygon(self.vertices.copy(), closed=True, facecolor=color, edgecolor='none',
+                                animated=True)
+        self.rms_envelope = Polygon(self.vertices.copy(), closed=True, facecolor='white', edgecolor='none',
+                                    alpha=0.35, animated=True)
+        ax.add_patch(self.envelope)
+        ax.add_patch(self.rms_envelope)
+        # Indicatore di picco: due linee orizzontali a +/- il picco recente
+        self.peak_lines = [ax.axhline(0, color='white', linewidth=0.8, linestyle=':', animated=True)
+                           for _ in range(2)]
+        self.level_text = ax.text(0.99, 0.95, "", transform=ax.transAxes, ha='right', va='top',
+                                  color='white', animated=True)
+        ax.set_xlim(times[0], 0)
+        ax.set_ylim(-1.05, 1.05)
+        self.draw_connection = self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # Dopo ogni ridisegno completo (anche per ridimensionamento) si salva il nuovo sfondo
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_artists()
+
+    def disconnect(self):
+        self.canvas.mpl_disconnect(self.draw_connection)
+
+    def update(self):
+        """Aggiorna i dati dallo storico e ridisegna solo gli artisti animati."""
+        if self.background is None:
+            return
+        mins, maxs, rms = self.history.snapshot()
+        self.envelope.set_xy(self._outline(mins, maxs))
+        self.rms_envelope.set_xy(self._outline(-rms, rms))
+
+        peak = self.history.peak()
+        color = 'red' if self.history.clipped else 'white'
+        for line, level in zip(self.peak_lines, (peak, -peak)):
+            line.set_ydata([level, level])
+            line.set_color(color)
+        decibels = 20 * np.log10(peak) if peak > 0 else -np.inf
+        self.level_text.set_text(f"{'CLIP  ' if self.history.clipped else ''}peak {decibels:.1f} dBFS")
+        self.level_text.set_color(color)
+
+        self.canvas.restore_region(self.background)
+        self._draw_artists()
+        self.canvas.blit(self.ax.bbox)
+
+    def _outline(self, low, high):
+        """Contorno chiuso del poligono compreso tra low e high."""
+        n = len(high)
+        self.vertices[:n, 1] = high
+        self.vertices[n:, 1] = low[::-1]
+        return self.vertices
+
+    def _draw_artists(self):
+        for artist in (self.envelope, self.rms_envelope, *self.peak_lines, self.level_text):
+            self.ax.draw_artist(artist)
+
+
+def _zigzag(low, high):
+    """Alterna i valori minimo e massimo di ogni bucket in un unico array."""
+    values = np.empty(2 * len(low), dtype=np.float64)
+    values[0::2] = low
+    values[1::2] = high
+    return values